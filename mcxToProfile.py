@@ -11,95 +11,258 @@ import os
 import optparse
 import subprocess
 import re
-from uuid import uuid4
-from Foundation import NSData, \
-                       NSDate, \
-                       NSPropertyListSerialization, \
-                       NSPropertyListMutableContainers, \
-                       NSPropertyListXMLFormat_v1_0, \
-                       CFPreferencesCopyKeyList, \
-                       CFPreferencesCopyMultiple, \
-                       kCFPreferencesCurrentUser, \
-                       kCFPreferencesAnyUser, \
-                       kCFPreferencesCurrentHost, \
-                       kCFPreferencesAnyHost, \
-                       kCFPreferencesCurrentApplication, \
-                       kCFPreferencesAnyApplication
+import time
+import datetime
+import csv
+import json
+import multiprocessing
+import threading
+import select
+import signal
+import struct
+import tempfile
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+import hashlib
+import contextlib
+import collections
+import binascii
+import mmap
+from uuid import uuid4, uuid5, NAMESPACE_URL
+
+class _PayloadRecord(object):
+    """One Custom Settings payload of a PayloadDict. The payload dict's boilerplate
+    keys are only filled in when the profile's data is built."""
+    __slots__ = ('uuid', 'content', 'domains', 'merge_key', 'order')
+
+    def __init__(self, uuid, content, domains, merge_key=None, order=0):
+        self.uuid = uuid
+        self.content = content
+        self.domains = domains
+        self.merge_key = merge_key
+        # Position in the profile, kept when the payload's UUID changes
+        self.order = order
+
 
 class PayloadDict:
     """Class to create and manipulate Configuration Profiles.
     The actual plist content can be accessed as a dictionary via the 'data' attribute.
+    Payloads are kept in the order they were added, indexed by UUID and by domain, so
+    they can be looked up, replaced and removed in constant time.
     """
-    def __init__(self, identifier, uuid=False, removal_allowed=False, organization='', displayname=''):
-        self.data = {}
-        self.data['PayloadVersion'] = 1
-        self.data['PayloadOrganization'] = organization
+    def __init__(self, identifier, uuid=False, removal_allowed=False, organization='', displayname='',
+                 deterministic=False, merge_domains=False, merge_conflicts='last'):
+        self._data = {}
+        self._data['PayloadVersion'] = 1
+        self._data['PayloadOrganization'] = organization
+        # With deterministic set, UUIDs are derived from the identifier and payload
+        # contents, so unchanged input produces an identical profile
+        self.deterministic = deterministic
+        # With merge_domains set, settings for a domain and state that already has a
+        # payload are merged into it, resolving conflicts as in mergePreferences()
+        self.merge_domains = merge_domains
+        self.merge_conflicts = merge_conflicts
+        self.merged_payloads = 0
+        self._merge_targets = {}
         if uuid:
-            self.data['PayloadUUID'] = uuid
+            self._data['PayloadUUID'] = uuid
+        elif deterministic:
+            self._data['PayloadUUID'] = makeDeterministicUUID(identifier)
         else:
-            self.data['PayloadUUID'] = makeNewUUID()
+            self._data['PayloadUUID'] = makeNewUUID()
         if removal_allowed:
-            self.data['PayloadRemovalDisallowed'] = False
+            self._data['PayloadRemovalDisallowed'] = False
         else:
-            self.data['PayloadRemovalDisallowed'] = True
-        self.data['PayloadType'] = 'Configuration'
-        self.data['PayloadScope'] = 'System'
-        self.data['PayloadDescription'] = "Included custom settings:\n"
-        self.data['PayloadDisplayName'] = displayname
-        self.data['PayloadIdentifier'] = identifier
+            self._data['PayloadRemovalDisallowed'] = True
+        self._data['PayloadType'] = 'Configuration'
+        self._data['PayloadScope'] = 'System'
+        self._data['PayloadDisplayName'] = displayname
+        self._data['PayloadIdentifier'] = identifier
 
         # store git commit for reference if possible
-        self.gitrev = None
-        root_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
-        if '.git' in os.listdir(root_dir):
-            git_p = subprocess.Popen('git rev-parse HEAD',
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    shell=True,
-                                    cwd=root_dir)
-            out, err = git_p.communicate()
-            if not git_p.returncode:
-                self.gitrev = out.strip()
-
-        # An empty list for 'sub payloads' that we'll fill later
-        self.data['PayloadContent'] = []
-
-    def _addPayload(self, payload_content_dict):
-        """Add a Custom Settings payload to the profile. Takes a dict which will be the
-        PayloadContent dict within the payload. Handles the boilerplate, naming and descriptive
-        elements.
-        """
-        domains = list(payload_content_dict.keys())
-        if len(domains) == 1:
-            domain = domains[0]
-            self.data['PayloadDescription'] += "%s\n" % domain
-        else:
-            domain = 'multiple preference domains'
-            self.data['PayloadDescription'] += '\n'.join(domains)
-
+        self.gitrev = getGitRevision()
+
+        # Payload records by UUID, and payload UUIDs by domain. PayloadContent and
+        # PayloadDescription are built from these when the data is next accessed.
+        self._payloads = collections.OrderedDict()
+        self._domain_index = {}
+        self._stale = True
+        # Set when a payload's UUID has changed, moving it to the end of _payloads
+        self._reordered = False
+        self._next_order = 0
+
+    @property
+    def data(self):
+        """The profile as a dict, with PayloadContent and PayloadDescription
+        rebuilt if payloads have changed since it was last accessed."""
+        if self._stale:
+            self._data['PayloadContent'] = [self._buildPayloadDict(record)
+                                            for record in self._records()]
+            self._data['PayloadDescription'] = self._buildDescription()
+            self._stale = False
+        return self._data
+
+    def _records(self):
+        """Return the payload records in the order they were added."""
+        if self._reordered:
+            self._payloads = collections.OrderedDict(
+                sorted(self._payloads.items(), key=lambda item: item[1].order))
+            self._reordered = False
+        return self._payloads.values()
+
+    def _buildPayloadDict(self, record):
         payload_dict = {}
         # Boilerplate
         payload_dict['PayloadVersion'] = 1
-        payload_dict['PayloadUUID'] = makeNewUUID()
+        payload_dict['PayloadUUID'] = record.uuid
         payload_dict['PayloadEnabled'] = True
         payload_dict['PayloadType'] = 'com.apple.ManagedClient.preferences'
         payload_dict['PayloadIdentifier'] = "%s.%s.alacarte.customsettings.%s" % (
-                                            'MCXToProfile', self.data['PayloadUUID'], payload_dict['PayloadUUID'])
-
-        # Update the top-level descriptive info
-        if self.data['PayloadDisplayName'] == '':
-            self.data['PayloadDisplayName'] = 'MCXToProfile: %s' % domain
-
+                                            'MCXToProfile', self._data['PayloadUUID'], record.uuid)
         # Add our actual MCX/Plist content
-        payload_dict['PayloadContent'] = payload_content_dict
+        payload_dict['PayloadContent'] = record.content
+        return payload_dict
+
+    @staticmethod
+    def _describeRecord(record):
+        if len(record.domains) == 1:
+            return "%s\n" % record.domains[0]
+        return '\n'.join(record.domains)
+
+    def _buildDescription(self, records=None):
+        if records is None:
+            records = self._records()
+        parts = ["Included custom settings:\n"]
+        for record in records:
+            parts.append(self._describeRecord(record))
+        if self.gitrev:
+            parts.append("\nGit revision: %s" % self.gitrev[0:10])
+        return ''.join(parts)
+
+    def _indexPayload(self, record):
+        for domain in record.domains:
+            self._domain_index.setdefault(domain, collections.OrderedDict())[record.uuid] = record
+        if record.merge_key and record.merge_key not in self._merge_targets:
+            self._merge_targets[record.merge_key] = record
+
+    def _unindexPayload(self, record):
+        for domain in record.domains:
+            del self._domain_index[domain][record.uuid]
+            if not self._domain_index[domain]:
+                del self._domain_index[domain]
+        if self._merge_targets.get(record.merge_key) is record:
+            del self._merge_targets[record.merge_key]
 
-        # Add to the profile's PayloadContent array
-        self.data['PayloadContent'].append(payload_dict)
+    def _addPayload(self, payload_content_dict):
+        """Add a Custom Settings payload to the profile. Takes a dict which will be the
+        PayloadContent dict within the payload. Handles the boilerplate, naming and descriptive
+        elements. Returns the payload's UUID.
+        """
+        domains = list(payload_content_dict.keys())
+        with timedPhase('payload-assembly', domains=domains):
+            merge_key = self._getMergeKey(payload_content_dict)
+            if merge_key in self._merge_targets:
+                return self._mergePayload(merge_key, payload_content_dict)
+
+            if self.deterministic:
+                payload_uuid = self._makePayloadUUID(payload_content_dict)
+            else:
+                payload_uuid = makeNewUUID()
+
+            # Update the top-level descriptive info
+            if self._data['PayloadDisplayName'] == '':
+                if len(domains) == 1:
+                    self._data['PayloadDisplayName'] = 'MCXToProfile: %s' % domains[0]
+                else:
+                    self._data['PayloadDisplayName'] = 'MCXToProfile: multiple preference domains'
+
+            record = _PayloadRecord(payload_uuid, payload_content_dict, tuple(domains), merge_key,
+                                    self._next_order)
+            self._next_order += 1
+            self._payloads[payload_uuid] = record
+            self._indexPayload(record)
+            self._stale = True
+            return payload_uuid
+
+    def _makePayloadUUID(self, payload_content_dict, own_uuid=None):
+        """Return a deterministic UUID for a payload with payload_content_dict that
+        no other payload in the profile has. own_uuid is the payload's current UUID,
+        if it's already in the profile."""
+        # Once timestamps are left out so they don't change the UUID
+        content_hash = canonicalHash(payload_content_dict, ignore_keys=('mcx_data_timestamp',))
+        payload_uuid = makeDeterministicUUID(self._data['PayloadIdentifier'], content_hash)
+        # Identical payloads in one profile still need distinct UUIDs
+        duplicate = 0
+        while payload_uuid in self._payloads and payload_uuid != own_uuid:
+            duplicate += 1
+            payload_uuid = makeDeterministicUUID(self._data['PayloadIdentifier'], content_hash,
+                                                 str(duplicate))
+        return payload_uuid
+
+    def _getMergeKey(self, payload_content_dict):
+        """Return the (domain, state, is Once) tuple identifying which payloads
+        payload_content_dict can be merged with, or None if merging is off or the
+        payload doesn't hold exactly one set of preference settings."""
+        if not self.merge_domains or len(payload_content_dict) != 1:
+            return None
+        domain = list(payload_content_dict.keys())[0]
+        states = payload_content_dict[domain]
+        if not hasattr(states, 'keys') or len(states) != 1:
+            return None
+        state = list(states.keys())[0]
+        if len(states[state]) != 1 or 'mcx_preference_settings' not in states[state][0]:
+            return None
+        return (domain, state, 'mcx_data_timestamp' in states[state][0])
+
+    def _mergePayload(self, merge_key, payload_content_dict):
+        """Merge the settings in payload_content_dict into the existing payload for
+        merge_key, and return that payload's UUID. With deterministic set, the merged
+        payload's UUID and Once timestamp are derived again from the merged settings,
+        so UUIDs returned for the payload before are no longer valid."""
+        domain, state, is_once = merge_key
+        target = self._merge_targets[merge_key]
+        settings = target.content[domain][state][0]
+        merged = dict(settings)
+        merged['mcx_preference_settings'] = mergePreferences(
+            settings['mcx_preference_settings'],
+            payload_content_dict[domain][state][0]['mcx_preference_settings'],
+            self.merge_conflicts, domain)
+        if self.deterministic and is_once:
+            merged['mcx_data_timestamp'] = makeDeterministicTimestamp(
+                domain, merged['mcx_preference_settings'])
+        # Replace rather than modify the containers, which may be shared with the inputs
+        target.content = {domain: {state: [merged]}}
+        if self.deterministic:
+            payload_uuid = self._makePayloadUUID(target.content, target.uuid)
+            if payload_uuid != target.uuid:
+                self._renamePayload(target, payload_uuid)
+        self.merged_payloads += 1
+        self._stale = True
+        return target.uuid
+
+    def _renamePayload(self, record, payload_uuid):
+        """Change the UUID of the payload record to payload_uuid, keeping its place."""
+        self._unindexPayload(record)
+        del self._payloads[record.uuid]
+        record.uuid = payload_uuid
+        self._payloads[payload_uuid] = record
+        self._reordered = True
+        self._indexPayload(record)
+        for domain in record.domains:
+            self._domain_index[domain] = collections.OrderedDict(
+                sorted(self._domain_index[domain].items(), key=lambda item: item[1].order))
 
     def addPayloadFromPlistContents(self, plist_dict, domain, manage, is_byhost=False):
         """Add one plist dict contents to the profile's payloads. domain is the
         preferences domain (ie. com.apple.finder), manage is one of 'Once', 'Often' or 'Always',
         and is_byhost is a boolean representing whether the preference is to be used as a ByHost.
+        Returns the payload's UUID.
         """
 
         payload_dict = {}
@@ -121,35 +284,773 @@ class PayloadDict:
 
         # Add a datestamp if we're managing 'Once'
         if manage == 'Once':
-            now = NSDate.new()
-            payload_dict[domain][state][0]['mcx_data_timestamp'] = now
-        self._addPayload(payload_dict)
+            if self.deterministic:
+                timestamp = makeDeterministicTimestamp(domain, plist_dict)
+            else:
+                timestamp = getPlistBackend().now()
+            payload_dict[domain][state][0]['mcx_data_timestamp'] = timestamp
+        return self._addPayload(payload_dict)
 
     def addPayloadFromMCX(self, mcxdata):
-        """Add MCX data to the profile's payloads.
+        """Add MCX data to the profile's payloads. Returns the payload's UUID.
         """
         # MCX is already 'configured', we just need to add the dict to the payload
-        self._addPayload(mcxdata)
-
-    def finalizeAndSave(self, output_path):
-        """Perform last modifications and save to an output plist.
+        return self._addPayload(mcxdata)
+
+    def findPayloads(self, domain):
+        """Return the UUIDs of the payloads managing domain, in the order they were added."""
+        return list(self._domain_index.get(domain, ()))
+
+    def getPayloadContent(self, payload_uuid):
+        """Return the PayloadContent dict of the payload with payload_uuid.
+        Raises KeyError if there's no such payload."""
+        return self._payloads[payload_uuid].content
+
+    def replacePayload(self, payload_uuid, payload_content_dict):
+        """Replace the PayloadContent dict of the payload with payload_uuid, keeping
+        its UUID and position. Raises KeyError if there's no such payload."""
+        record = self._payloads[payload_uuid]
+        self._unindexPayload(record)
+        record.content = payload_content_dict
+        record.domains = tuple(payload_content_dict.keys())
+        record.merge_key = self._getMergeKey(payload_content_dict)
+        self._indexPayload(record)
+        self._stale = True
+
+    def removePayload(self, payload_uuid):
+        """Remove the payload with payload_uuid from the profile.
+        Raises KeyError if there's no such payload."""
+        record = self._payloads.pop(payload_uuid)
+        self._unindexPayload(record)
+        self._stale = True
+
+    def collapseDuplicateSubtrees(self):
+        """Make identical dicts and arrays in the payloads share one object,
+        see collapseDuplicateSubtrees()."""
+        records = list(self._records())
+        collapsed = collapseDuplicateSubtrees([record.content for record in records])
+        for record, content in zip(records, collapsed):
+            record.content = content
+        self._stale = True
+
+    def split(self, max_bytes=None, max_payloads=None, plist_format='xml'):
+        """Return the payloads divided into as few profiles as fit, in payload order,
+        within max_bytes serialized bytes and max_payloads payloads each, as a list of
+        (profile, estimated bytes) tuples. The profiles are named '<identifier>.<n>'
+        and otherwise have the same settings; a profile that fits as a whole is
+        returned unchanged. Each payload's contribution to the size is worked out once,
+        and a payload larger than max_bytes is put in a profile by itself."""
+        data = self.data
+        records = list(self._records())
+        estimator = _BinaryPlistSize if plist_format == 'binary' else _XMLPlistSize
+        # Everything but the payloads and their description lines, with room for
+        # the longest derived identifier and display name
+        envelope = estimator.footprint(dict(data,
+            PayloadIdentifier='%s.%d' % (data['PayloadIdentifier'], 10 ** 6),
+            PayloadDisplayName='%s (%d of %d)' % (data['PayloadDisplayName'], 10 ** 6, 10 ** 6),
+            PayloadContent=[],
+            PayloadDescription=self._buildDescription([])))
+        footprints = [estimator.footprint(payload, 2, len(_escapeXML(self._describeRecord(record))))
+                      for record, payload in zip(records, data['PayloadContent'])]
+
+        # First fit, keeping payloads in their original order within each profile
+        bins = []
+        for record, footprint in zip(records, footprints):
+            for size, part_records in bins:
+                if (not max_payloads or len(part_records) < max_payloads) and \
+                (not max_bytes or size.sizeWith(footprint) <= max_bytes):
+                    size.add(footprint)
+                    part_records.append(record)
+                    break
+            else:
+                size = estimator()
+                size.add(envelope)
+                size.add(footprint)
+                bins.append((size, [record]))
+        if len(bins) <= 1:
+            if not bins:
+                size = estimator()
+                size.add(envelope)
+                return [(self, size.estimate())]
+            return [(self, bins[0][0].estimate())]
+
+        profiles = []
+        for index, (size, part_records) in enumerate(bins, 1):
+            identifier = '%s.%d' % (data['PayloadIdentifier'], index)
+            part = PayloadDict(identifier, deterministic=self.deterministic)
+            for key, value in self._data.items():
+                if key not in ('PayloadUUID', 'PayloadIdentifier', 'PayloadContent', 'PayloadDescription'):
+                    part._data[key] = value
+            part._data['PayloadDisplayName'] = '%s (%d of %d)' % (
+                data['PayloadDisplayName'], index, len(bins))
+            for order, record in enumerate(part_records):
+                part_record = _PayloadRecord(record.uuid, record.content, record.domains,
+                                             record.merge_key, order)
+                part._payloads[record.uuid] = part_record
+                part._indexPayload(part_record)
+            part._next_order = len(part_records)
+            profiles.append((part, size.estimate()))
+        return profiles
+
+    def finalizeAndSave(self, output_path, streaming=False, output_format='xml'):
+        """Perform last modifications and save to an output plist. With streaming,
+        the XML is written out incrementally instead of being built in memory.
+        output_format is 'xml' or 'binary'; binary can't be streamed.
         """
-        if self.gitrev:
-            self.data['PayloadDescription'] += "\nGit revision: %s" % self.gitrev[0:10]
-        writePlist(self.data, output_path)
+        with timedPhase('serialize', path=output_path, format=output_format) as event:
+            if streaming and output_format == 'xml':
+                writePlistStreaming(self.data, output_path)
+            else:
+                writePlist(self.data, output_path, output_format)
+            if event is not None:
+                event['bytes'] = os.path.getsize(output_path)
 
 
 def makeNewUUID():
     return str(uuid4())
 
 
+# Namespace for UUIDs generated with makeDeterministicUUID()
+MCXTOPROFILE_UUID_NAMESPACE = uuid5(NAMESPACE_URL, 'https://github.com/timsutton/mcxToProfile')
+
+
+def makeDeterministicUUID(*parts):
+    """Return a name-based (version 5) UUID derived from the given strings, which
+    is the same every time for the same parts."""
+    name = '\n'.join(parts)
+    if sys.version_info[0] < 3 and isinstance(name, unicode):
+        name = name.encode('UTF-8')
+    return str(uuid5(MCXTOPROFILE_UUID_NAMESPACE, name))
+
+
+# Deterministic 'Once' timestamps fall in the 20 years after 2001-01-01 UTC
+DETERMINISTIC_TIMESTAMP_BASE = 978307200
+DETERMINISTIC_TIMESTAMP_RANGE = 20 * 365 * 24 * 3600
+
+
+def deterministicTimestampSeconds(digest):
+    """Return the seconds since the epoch of the deterministic timestamp for a hex digest."""
+    return DETERMINISTIC_TIMESTAMP_BASE + int(digest[0:16], 16) % DETERMINISTIC_TIMESTAMP_RANGE
+
+
+def makeDeterministicTimestamp(domain, settings):
+    """Return an mcx_data_timestamp date for the settings of domain that is the same
+    every time for the same settings, and changes when they do, so that unchanged
+    'Once' settings produce an identical payload and changed ones are applied again."""
+    seconds = deterministicTimestampSeconds(canonicalHash({domain: settings}))
+    return getPlistBackend().dateFromTimestamp(seconds)
+
+
+if sys.version_info[0] < 3:
+    _text_types = (str, unicode)
+    _int_types = (int, long)
+else:
+    _text_types = (str,)
+    _int_types = (int,)
+_digest_cached_types = _text_types + _int_types
+
+
+def _scalarBytes(obj):
+    """Return a byte string encoding a plist scalar, for hashing."""
+    if isinstance(obj, bool):
+        return b'b1' if obj else b'b0'
+    if isinstance(obj, _int_types):
+        return b'i' + str(obj).encode('ascii')
+    if isinstance(obj, float):
+        return b'f' + repr(obj).encode('ascii')
+    if isinstance(obj, _text_types):
+        if not isinstance(obj, bytes):
+            obj = obj.encode('UTF-8')
+        return b's' + obj
+    if isinstance(obj, bytes):
+        return b'x' + obj
+    if hasattr(obj, 'data') and isinstance(obj.data, bytes):
+        # plistlib.Data on Python 2
+        return b'x' + obj.data
+    if hasattr(obj, 'bytes') and hasattr(obj, 'length'):
+        # NSData
+        return b'x' + bytes(obj.bytes())
+    return b'o' + str(obj).encode('UTF-8')
+
+
+def _plistDataView(obj):
+    """Return a buffer over the bytes of a plist data value (bytes, NSData or
+    Python 2's plistlib.Data) that shares its memory, or None for any other object."""
+    if isinstance(obj, _text_types):
+        return None
+    if isinstance(obj, (bytes, bytearray)):
+        return memoryview(obj)
+    if hasattr(obj, 'bytes') and hasattr(obj, 'length'):
+        # NSData
+        return obj.bytes()
+    if hasattr(obj, 'data') and isinstance(obj.data, bytes):
+        # plistlib.Data on Python 2
+        return memoryview(obj.data)
+    return None
+
+
+def _scalarSHA1(obj):
+    """Return the SHA-1 digest of _scalarBytes(obj), hashing data values in place
+    instead of copying them."""
+    data = _plistDataView(obj)
+    if data is None:
+        return hashlib.sha1(_scalarBytes(obj)).digest()
+    hasher = hashlib.sha1(b'x')
+    hasher.update(data)
+    return hasher.digest()
+
+
+# Digests of recently hashed keys and short scalar values, which recur throughout
+# preference trees. Floats aren't included, since 0.0 and -0.0 compare equal.
+_scalar_digests = {}
+_SCALAR_DIGESTS_MAX = 100000
+
+
+def _scalarDigest(obj):
+    """Return the SHA-1 digest of _scalarBytes(obj), remembering it for short
+    strings, integers and booleans."""
+    cache_key = (type(obj), obj)
+    digest = _scalar_digests.get(cache_key) if isinstance(obj, _digest_cached_types) else None
+    if digest is None:
+        digest = _scalarSHA1(obj)
+        if isinstance(obj, _digest_cached_types) and not \
+                (isinstance(obj, _text_types) and len(obj) > 256):
+            if len(_scalar_digests) >= _SCALAR_DIGESTS_MAX:
+                _scalar_digests.clear()
+            _scalar_digests[cache_key] = digest
+    return digest
+
+
+def _isPlistArray(obj):
+    return isinstance(obj, (list, tuple)) or hasattr(obj, 'objectAtIndex_')
+
+
+def _canonicalDigest(obj, ignore_keys=(), visit=None, path=()):
+    """Return the SHA-1 digest of obj with dict keys sorted. The digest of a dict
+    or array is built from the digests of its members, so each object is hashed
+    once. If given, visit is called with each dict and array, its digest and its
+    path, a tuple of the keys and indexes leading to it from the root."""
+    if isinstance(obj, _digest_cached_types):
+        return _scalarDigest(obj)
+    if hasattr(obj, 'keys'):
+        parts = [b'd']
+        for key in sorted(obj.keys()):
+            if key in ignore_keys:
+                continue
+            parts.append(_scalarDigest(key))
+            parts.append(_canonicalDigest(obj[key], ignore_keys, visit,
+                                          visit and path + (key,)))
+    elif _isPlistArray(obj):
+        parts = [b'a']
+        for index, item in enumerate(obj):
+            parts.append(_canonicalDigest(item, ignore_keys, visit,
+                                          visit and path + (index,)))
+    else:
+        return _scalarDigest(obj)
+    digest = hashlib.sha1(b''.join(parts)).digest()
+    if visit:
+        visit(obj, digest, path)
+    return digest
+
+
+def canonicalHash(obj, ignore_keys=()):
+    """Return a hex digest of a plist object that depends only on its contents,
+    not on dict ordering or the plist backend's container types. Values of any dict
+    keys in ignore_keys are left out."""
+    return binascii.hexlify(_canonicalDigest(obj, ignore_keys)).decode('ascii')
+
+
+# Ways of resolving a key set to different values by two merged inputs
+MERGE_CONFLICTS = ('last', 'first', 'error')
+
+
+def mergePreferences(base, overlay, conflicts='last', path=''):
+    """Return a new dict with the keys of both preference dicts base and overlay.
+    Dicts found under the same key in both are merged the same way. Any other
+    value set differently by both is resolved by conflicts: 'last' keeps overlay's
+    value, 'first' keeps base's, and 'error' raises ProfileBuildError. Arrays are
+    not combined. Neither argument is modified."""
+    merged = dict(base)
+    for key in overlay.keys():
+        value = overlay[key]
+        if key not in merged:
+            merged[key] = value
+            continue
+        key_path = '%s/%s' % (path, key) if path else key
+        existing = merged[key]
+        if hasattr(existing, 'keys') and hasattr(value, 'keys'):
+            merged[key] = mergePreferences(existing, value, conflicts, key_path)
+        elif conflicts == 'last':
+            # Equal values needn't be compared, as either one can be kept
+            merged[key] = value
+        elif conflicts == 'error' and canonicalHash(existing) != canonicalHash(value):
+            raise ProfileBuildError("Conflicting values for %s" % key_path)
+    return merged
+
+
+def collapseDuplicateSubtrees(obj):
+    """Return a copy of obj in which identical dicts and arrays are one shared
+    object. The XML is unchanged, but binary plist writers store a shared object
+    only once, and the profile takes less memory. Scalars aren't copied."""
+    shared = {}
+
+    def collapse(value):
+        if hasattr(value, 'keys'):
+            copy = {}
+            parts = [b'd']
+            for key in sorted(value.keys()):
+                copy[key], digest = collapse(value[key])
+                parts.append(hashlib.sha1(_scalarBytes(key)).digest())
+                parts.append(digest)
+        elif _isPlistArray(value):
+            copy = []
+            parts = [b'a']
+            for item in value:
+                item, digest = collapse(item)
+                copy.append(item)
+                parts.append(digest)
+        else:
+            return value, _scalarSHA1(value)
+        # Same digests as _canonicalDigest()
+        digest = hashlib.sha1(b''.join(parts)).digest()
+        return shared.setdefault(digest, copy), digest
+
+    return collapse(obj)[0]
+
+
+def _estimatePlistSize(obj, depth=0):
+    """Return the size in bytes of obj serialized at depth in an XML plist."""
+    return sum(len(line) for line in _iterXMLPlistValue(obj, depth))
+
+
+class _XMLPlistSize(object):
+    """Running estimate of the size of an XML plist assembled from objects whose
+    footprints are added to it, see PayloadDict.split()."""
+
+    def __init__(self):
+        self.bytes = len(_XML_PLIST_HEADER) + len(b'</plist>\n')
+
+    @staticmethod
+    def footprint(obj, depth=0, extra_bytes=0):
+        """Return what obj, at depth, and extra_bytes of string add to a plist."""
+        return _estimatePlistSize(obj, depth) + extra_bytes
+
+    def sizeWith(self, footprint):
+        return self.bytes + footprint
+
+    def add(self, footprint):
+        self.bytes += footprint
+
+    def estimate(self):
+        return self.bytes
+
+
+def _binaryIntSize(count):
+    for size in (1, 2, 4):
+        if count < 1 << (8 * size):
+            return size
+    return 8
+
+
+def _binaryLengthSize(length):
+    # Lengths under 15 fit in the object's marker byte
+    if length < 15:
+        return 0
+    return 1 + _binaryIntSize(length)
+
+
+def _binaryScalarSize(obj):
+    if isinstance(obj, bool) or obj is None:
+        return 1
+    if isinstance(obj, _int_types):
+        if obj < 0:
+            return 9
+        return 1 + (_binaryIntSize(obj) if obj < 1 << 63 else 16)
+    if isinstance(obj, (float, datetime.datetime)) or hasattr(obj, 'timeIntervalSince1970'):
+        return 9
+    if isinstance(obj, _text_types):
+        if isinstance(obj, bytes):
+            obj = obj.decode('UTF-8')
+        try:
+            return 1 + _binaryLengthSize(len(obj)) + len(obj.encode('ascii'))
+        except UnicodeError:
+            encoded = obj.encode('UTF-16BE')
+            return 1 + _binaryLengthSize(len(encoded) // 2) + len(encoded)
+    data = _plistDataView(obj)
+    if data is not None:
+        return 1 + _binaryLengthSize(len(data)) + len(data)
+    return len(_scalarBytes(obj))
+
+
+class _BinaryPlistSize(object):
+    """Running estimate of the size of a binary plist assembled from objects whose
+    footprints are added to it. As in the format, each distinct scalar is stored
+    once, each dict and array as a header and a reference to each member, and every
+    object has an entry in the offset table."""
+
+    def __init__(self):
+        self.scalars = set()
+        self.bytes = 0
+        self.refs = 0
+        self.containers = 0
+
+    @staticmethod
+    def footprint(obj, depth=0, extra_bytes=0):
+        """Return what obj, referenced from a container unless depth is 0, and
+        extra_bytes of string add to a plist, as a tuple of its scalars' digests and
+        sizes, its container header bytes, references and containers."""
+        scalars = {}
+        totals = [extra_bytes, 1 if depth else 0, 0]
+
+        def walk(value):
+            if hasattr(value, 'keys'):
+                totals[0] += 1 + _binaryLengthSize(len(value))
+                totals[1] += 2 * len(value)
+                totals[2] += 1
+                for key in value.keys():
+                    walk(key)
+                    walk(value[key])
+            elif _isPlistArray(value):
+                totals[0] += 1 + _binaryLengthSize(len(value))
+                totals[1] += len(value)
+                totals[2] += 1
+                for item in value:
+                    walk(item)
+            else:
+                scalars[_scalarDigest(value)] = _binaryScalarSize(value)
+        walk(obj)
+        return scalars, totals[0], totals[1], totals[2]
+
+    @staticmethod
+    def _size(object_bytes, refs, objects):
+        offset_table = 8 + object_bytes + refs * _binaryIntSize(objects)
+        return offset_table + objects * _binaryIntSize(offset_table) + 32
+
+    def sizeWith(self, footprint):
+        scalars, header_bytes, refs, containers = footprint
+        new_scalars = [digest for digest in scalars if digest not in self.scalars]
+        return self._size(self.bytes + header_bytes + sum(scalars[d] for d in new_scalars),
+                          self.refs + refs,
+                          self.containers + containers + len(self.scalars) + len(new_scalars))
+
+    def add(self, footprint):
+        scalars, header_bytes, refs, containers = footprint
+        for digest, size in scalars.items():
+            if digest not in self.scalars:
+                self.scalars.add(digest)
+                self.bytes += size
+        self.bytes += header_bytes
+        self.refs += refs
+        self.containers += containers
+
+    def estimate(self):
+        return self._size(self.bytes, self.refs, self.containers + len(self.scalars))
+
+
+def findDuplicateSubtrees(obj):
+    """Return a list of the dicts and arrays that occur more than once in obj,
+    largest saving first. Each is a dict with the 'count' of copies, the XML size
+    in 'bytes' of one copy, and the 'paths' to the copies as '/'-separated keys
+    and indexes. A subtree that only repeats inside a larger repeated one is left out."""
+    found = {}
+    _canonicalDigest(obj, visit=lambda value, digest, path:
+                     found.setdefault(digest, []).append((path, value)))
+    repeated = [copies for copies in found.values() if len(copies) > 1]
+    repeated_paths = set(path for copies in repeated for path, value in copies)
+
+    duplicates = []
+    for copies in repeated:
+        if all(any(path[:length] in repeated_paths for length in range(len(path)))
+               for path, value in copies):
+            continue
+        size = _estimatePlistSize(copies[0][1])
+        duplicates.append({'count': len(copies),
+                           'bytes': size,
+                           'paths': ['/'.join(str(part) for part in path)
+                                     for path, value in copies]})
+    duplicates.sort(key=lambda d: (-(d['count'] - 1) * d['bytes'], d['paths'][0]))
+    return duplicates
+
+
+def diffPlists(old, new, ignore_keys=()):
+    """Return the differences between two plist objects as a list of (change,
+    path, old value, new value) tuples. change is '+' for an added key, '-' for a
+    removed key and '~' for a changed value, and path is the list of keys and
+    indexes leading to it. Dict ordering and the values of ignore_keys don't count.
+    Both trees are hashed once up front, and subtrees whose hashes match are
+    skipped without being walked."""
+    digests = {}
+
+    def remember(value, digest, path):
+        digests[id(value)] = digest
+    _canonicalDigest(old, ignore_keys, visit=remember)
+    _canonicalDigest(new, ignore_keys, visit=remember)
+
+    def digest(value):
+        if id(value) in digests:
+            return digests[id(value)]
+        return _scalarSHA1(value)
+
+    changes = []
+
+    def compare(old_value, new_value, path):
+        if digest(old_value) == digest(new_value):
+            return
+        if hasattr(old_value, 'keys') and hasattr(new_value, 'keys'):
+            for key in sorted(set(old_value.keys()) | set(new_value.keys())):
+                if key in ignore_keys:
+                    continue
+                if key not in new_value:
+                    changes.append(('-', path + [key], old_value[key], None))
+                elif key not in old_value:
+                    changes.append(('+', path + [key], None, new_value[key]))
+                else:
+                    compare(old_value[key], new_value[key], path + [key])
+        elif _isPlistArray(old_value) and _isPlistArray(new_value) and \
+                len(old_value) == len(new_value):
+            for index in range(len(old_value)):
+                compare(old_value[index], new_value[index], path + [index])
+        else:
+            changes.append(('~', path, old_value, new_value))
+
+    compare(old, new, [])
+    return changes
+
+
+# Keys left out when comparing profiles: UUIDs, payload identifiers (which hold
+# the UUIDs), and Once timestamps
+PROFILE_DIFF_IGNORED_KEYS = ('PayloadUUID', 'PayloadIdentifier')
+PROFILE_DIFF_IGNORED_SETTINGS = ('mcx_data_timestamp',)
+
+
+def _profileForDiff(data):
+    # The description only lists the payloads' domains and the git revision
+    top = dict((k, v) for k, v in data.items()
+               if k not in ('PayloadUUID', 'PayloadContent', 'PayloadDescription'))
+    payloads = [dict((k, v) for k, v in payload.items() if k not in PROFILE_DIFF_IGNORED_KEYS)
+                for payload in data.get('PayloadContent', [])]
+    return top, payloads
+
+
+def _payloadDomains(payload):
+    content = payload.get('PayloadContent')
+    if not hasattr(content, 'keys'):
+        return ''
+    return ', '.join(sorted(content.keys()))
+
+
+def diffProfiles(old_data, new_data):
+    """Return the differences between two Custom Settings profiles in the form
+    returned by diffPlists(). UUIDs, Once timestamps, the generated
+    description and the order of payloads are ignored. Payloads with identical contents are paired
+    off by their hashes; the rest are matched by domain and compared key by key.
+    A payload without a match is reported as added or removed as a whole."""
+    old_top, old_payloads = _profileForDiff(old_data)
+    new_top, new_payloads = _profileForDiff(new_data)
+    changes = diffPlists(old_top, new_top)
+
+    unmatched = {}
+    for index, payload in enumerate(old_payloads):
+        unmatched.setdefault(canonicalHash(payload, PROFILE_DIFF_IGNORED_SETTINGS), []).append(index)
+    changed_new = []
+    for payload in new_payloads:
+        same = unmatched.get(canonicalHash(payload, PROFILE_DIFF_IGNORED_SETTINGS))
+        if same:
+            same.pop(0)
+        else:
+            changed_new.append(payload)
+    changed_old = [old_payloads[i] for i in sorted(i for indexes in unmatched.values() for i in indexes)]
+
+    by_domains = {}
+    for payload in changed_old:
+        by_domains.setdefault(_payloadDomains(payload), []).append(payload)
+    for payload in changed_new:
+        domains = _payloadDomains(payload)
+        if by_domains.get(domains):
+            changes.extend(diffPlists(by_domains[domains].pop(0), payload, PROFILE_DIFF_IGNORED_SETTINGS))
+        else:
+            changes.append(('+', ['PayloadContent', domains], None, payload))
+    removed = set(id(payload) for payloads in by_domains.values() for payload in payloads)
+    for payload in changed_old:
+        if id(payload) in removed:
+            changes.append(('-', ['PayloadContent', _payloadDomains(payload)], payload, None))
+    return changes
+
+
+def hashFile(path):
+    """Return the SHA-256 hex digest of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildCache(object):
+    """On-disk record of the profiles built from each combination of inputs and
+    options, used to skip rebuilding profiles whose inputs haven't changed.
+    Each entry is a small JSON file named by the input key, holding the output
+    path and the hash of the profile written for it."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, input_paths, settings):
+        """Return the cache key for a profile built from the files at input_paths
+        with the settings dict (identifier, options and output path)."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(settings, sort_keys=True).encode('UTF-8'))
+        for path in input_paths:
+            digest.update(b'\0' + os.path.abspath(path).encode('UTF-8') + b'\0')
+            digest.update(hashFile(path).encode('ascii'))
+        return digest.hexdigest()
+
+    def isFresh(self, key, output_path):
+        """Return True if key was recorded for output_path and the file there is
+        still the one that was written."""
+        entry_path = os.path.join(self.cache_dir, key)
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+            return (entry['output'] == os.path.abspath(output_path) and
+                    hashFile(output_path) == entry['output_sha256'])
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+    def record(self, key, output_path):
+        """Record that the profile for key has been written to output_path."""
+        entry = {'output': os.path.abspath(output_path),
+                 'output_sha256': hashFile(output_path)}
+        _writeFileAtomically(json.dumps(entry).encode('UTF-8'),
+                             os.path.join(self.cache_dir, key))
+
+
+_git_revision = False
+
+
+def getGitRevision():
+    """Return the git commit of the directory containing this tool, or None if
+    it's not in a git repository. Looked up once per process."""
+    global _git_revision
+    if _git_revision is False:
+        _git_revision = None
+        root_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
+        if '.git' in os.listdir(root_dir):
+            with timedPhase('git-rev-parse'):
+                git_p = subprocess.Popen('git rev-parse HEAD',
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        shell=True,
+                                        cwd=root_dir)
+                out, err = git_p.communicate()
+            if not git_p.returncode:
+                _git_revision = out.strip().decode('UTF-8')
+    return _git_revision
+
+
 def errorAndExit(errmsg):
     print(errmsg, file=sys.stderr)
     exit(-1)
 
 
-# Functions readPlist(), readPlistFromString() and writePlist(), class
-# FoundationPlistException() and its subclasses borrowed with permission
+class ProfileBuildError(Exception):
+    """Raised when a profile can't be built from its inputs."""
+    pass
+
+
+class PhaseTimer(object):
+    """Collects the duration of each phase of a build (dscl, CFPreferences reads,
+    plist decoding, payload assembly, git rev-parse and serialization) for the
+    --timings report. Phases are recorded through timedPhase()."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.events = []
+
+    def report(self):
+        """Return a dict with the total time, per-phase totals and every event."""
+        phases = {}
+        for event in self.events:
+            totals = phases.setdefault(event['phase'], {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            totals['count'] += 1
+            totals['seconds'] += event['seconds']
+            totals['bytes'] += event.get('bytes') or 0
+        return {'command': sys.argv,
+                'total_seconds': time.time() - self.start,
+                'phases': phases,
+                'events': self.events}
+
+
+_phase_timer = None
+
+
+@contextlib.contextmanager
+def timedPhase(name, **details):
+    """Context manager recording the time spent in its block as a phase called
+    name, with details such as the input path. It yields the event dict, so sizes
+    known only later can be added, or None when timings aren't being collected."""
+    if _phase_timer is None:
+        yield None
+        return
+    event = dict(details, phase=name)
+    start = time.time()
+    try:
+        yield event
+    finally:
+        event['seconds'] = time.time() - start
+        _phase_timer.events.append(event)
+
+
+_instrumented = False
+
+
+def runInstrumented(func, timings_path=None, profile_path=None, profiler='cprofile'):
+    """Run func, writing a JSON phase breakdown to timings_path and/or a cProfile
+    or tracemalloc report to profile_path when it finishes, even by exiting.
+    A path of '-' writes the timings to standard error, so they don't mix with the
+    command's output."""
+    global _instrumented, _phase_timer
+    _instrumented = True
+    if timings_path:
+        _phase_timer = PhaseTimer()
+    if profile_path and profiler == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start(25)
+    elif profile_path:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        return func()
+    finally:
+        if profile_path and profiler == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(profile_path, 'w') as report:
+                report.write("Peak traced memory: %d bytes, at exit: %d bytes\n\n" % (peak, current))
+                for stat in snapshot.statistics('lineno')[0:50]:
+                    report.write("%s\n" % stat)
+        elif profile_path:
+            import pstats
+            profile.disable()
+            with open(profile_path, 'w') as report:
+                pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(50)
+        if timings_path:
+            timings = json.dumps(_phase_timer.report(), indent=2, sort_keys=True)
+            if timings_path == '-':
+                print(timings, file=sys.stderr)
+            else:
+                with open(timings_path, 'w') as timings_file:
+                    timings_file.write(timings + '\n')
+
+
+# The readPlist(), readPlistFromString() and writePlist() methods of
+# FoundationPlistBackend, class FoundationPlistException() and its subclasses
+# borrowed with permission
 # from Greg Neagle of the Munki project:
 #
 # http://code.google.com/p/munki
@@ -209,54 +1110,367 @@ class NSPropertyListWriteException(FoundationPlistException):
     pass
 
 
+class FoundationPlistBackend(object):
+    """Plist backend using NSPropertyListSerialization through PyObjC."""
+    name = 'foundation'
+
+    def __init__(self):
+        # Raises ImportError when PyObjC isn't available
+        import Foundation
+        self.Foundation = Foundation
+
+    def readPlist(self, filepath):
+        """
+        Read a .plist file from filepath.  Return the unpacked root object
+        (which is usually a dictionary).
+        """
+        # Mapped rather than read, where the file system allows it
+        plistData, error = self.Foundation.NSData.dataWithContentsOfFile_options_error_(
+            filepath, self.Foundation.NSDataReadingMappedIfSafe, None)
+        dataObject, plistFormat, error = \
+            self.Foundation.NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
+                         plistData, self.Foundation.NSPropertyListMutableContainers, None, None)
+        if error:
+            if sys.version_info[0] < 3:
+                error = error.encode('ascii', 'ignore')
+            errmsg = "%s in file %s" % (error, filepath)
+            raise NSPropertyListSerializationException(errmsg)
+        else:
+            return dataObject
+
+    def readPlistFromString(self, data):
+        '''Read a plist data from a string. Return the root object.'''
+        if sys.version_info[0] < 3:
+            plistData = buffer(data)
+        elif isinstance(data, bytes):
+            # Passed to Foundation as an NSData sharing the bytes' memory
+            plistData = data
+        else:
+            plistData = self.Foundation.NSData.dataWithBytes_length_(data, len(data))
+        dataObject, plistFormat, error = \
+         self.Foundation.NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
+                        plistData, self.Foundation.NSPropertyListMutableContainers, None, None)
+        if error:
+            if sys.version_info[0] < 3:
+                error = error.encode('ascii', 'ignore')
+            raise NSPropertyListSerializationException(error)
+        else:
+            return dataObject
+
+    def writePlist(self, dataObject, filepath, plist_format='xml'):
+        '''
+        Write 'rootObject' as a plist to filepath.
+        '''
+        if plist_format == 'binary':
+            ns_format = self.Foundation.NSPropertyListBinaryFormat_v1_0
+        else:
+            ns_format = self.Foundation.NSPropertyListXMLFormat_v1_0
+        plistData, error = \
+         self.Foundation.NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
+                                dataObject, ns_format, None)
+        if error:
+            if sys.version_info[0] < 3:
+                error = error.encode('ascii', 'ignore')
+            raise NSPropertyListSerializationException(error)
+        else:
+            if plistData.writeToFile_atomically_(filepath, True):
+                return
+            else:
+                raise NSPropertyListWriteException(
+                                    "Failed to write plist data to %s" % filepath)
+
+    def writePlistToString(self, rootObject, plist_format='xml'):
+        '''Return 'rootObject' as a plist-formatted byte string.'''
+        if plist_format == 'binary':
+            ns_format = self.Foundation.NSPropertyListBinaryFormat_v1_0
+        else:
+            ns_format = self.Foundation.NSPropertyListXMLFormat_v1_0
+        plistData, error = \
+         self.Foundation.NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
+                                rootObject, ns_format, None)
+        if error:
+            if sys.version_info[0] < 3:
+                error = error.encode('ascii', 'ignore')
+            raise NSPropertyListSerializationException(error)
+        else:
+            return bytes(plistData)
+
+    def now(self):
+        return self.Foundation.NSDate.new()
+
+    def dateFromTimestamp(self, seconds):
+        return self.Foundation.NSDate.dateWithTimeIntervalSince1970_(seconds)
+
+# End borrowed functions and classes from FoundationPlist.
+
+
+class PlistlibPlistBackend(object):
+    """Plist backend using the standard library's plistlib, for platforms
+    where PyObjC isn't available."""
+    name = 'plistlib'
+
+    def __init__(self):
+        import plistlib
+        self.plistlib = plistlib
+
+    def _loads(self, data):
+        if hasattr(self.plistlib, 'loads'):
+            # detects XML or binary format
+            return self.plistlib.loads(data)
+        if data[:len(BINARY_PLIST_MAGIC)] == BINARY_PLIST_MAGIC:
+            raise ValueError("binary plists can't be read by plistlib before Python 3.4")
+        return self.plistlib.readPlistFromString(data)
+
+    def _load(self, plist_file):
+        if hasattr(self.plistlib, 'load'):
+            return self.plistlib.load(plist_file)
+        if plist_file.read(len(BINARY_PLIST_MAGIC)) == BINARY_PLIST_MAGIC:
+            raise ValueError("binary plists can't be read by plistlib before Python 3.4")
+        plist_file.seek(0)
+        return self.plistlib.readPlist(plist_file)
+
+    def _dumps(self, dataObject, plist_format='xml'):
+        if hasattr(self.plistlib, 'dumps'):
+            if plist_format == 'binary':
+                return self.plistlib.dumps(dataObject, fmt=self.plistlib.FMT_BINARY)
+            return self.plistlib.dumps(dataObject, fmt=self.plistlib.FMT_XML)
+        if plist_format == 'binary':
+            raise ValueError("binary plists can't be written by plistlib before Python 3.4")
+        return self.plistlib.writePlistToString(dataObject)
+
+    def readPlist(self, filepath):
+        """Read a .plist file from filepath. Return the root object. The file is
+        memory-mapped and parsed from the mapping, so it isn't copied into memory
+        alongside the objects decoded from it."""
+        try:
+            with open(filepath, 'rb') as plist_file:
+                try:
+                    mapped = mmap.mmap(plist_file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    # Empty files and pipes can't be mapped
+                    return self._loads(plist_file.read())
+                try:
+                    return self._load(mapped)
+                finally:
+                    mapped.close()
+        except Exception as error:
+            raise NSPropertyListSerializationException(
+                "%s in file %s" % (error, filepath))
+
+    def readPlistFromString(self, data):
+        """Read a plist data from a string. Return the root object."""
+        if not isinstance(data, bytes):
+            data = data.encode('UTF-8')
+        try:
+            return self._loads(data)
+        except Exception as error:
+            raise NSPropertyListSerializationException(str(error))
+
+    def writePlist(self, dataObject, filepath, plist_format='xml'):
+        """Write dataObject as a plist to filepath, replacing any existing
+        file atomically. plist_format is 'xml' or 'binary'."""
+        _writeFileAtomically(self.writePlistToString(dataObject, plist_format), filepath)
+
+    def writePlistToString(self, dataObject, plist_format='xml'):
+        """Return dataObject as a plist byte string. plist_format is 'xml' or 'binary'."""
+        try:
+            return self._dumps(dataObject, plist_format)
+        except Exception as error:
+            raise NSPropertyListSerializationException(str(error))
+
+    def now(self):
+        return self.dateFromTimestamp(time.time())
+
+    def dateFromTimestamp(self, seconds):
+        # plistlib stores naive datetimes as UTC
+        return datetime.datetime(*time.gmtime(seconds)[0:6])
+
+
+# Output formats accepted by writePlist()
+PLIST_FORMATS = ('xml', 'binary')
+
+BINARY_PLIST_MAGIC = b'bplist00'
+
+PLIST_BACKENDS = {
+    'foundation': FoundationPlistBackend,
+    'plistlib': PlistlibPlistBackend,
+}
+
+_plist_backend = None
+
+
+def setPlistBackend(name='auto'):
+    """Select the plist backend used by readPlist(), readPlistFromString()
+    and writePlist(). name is one of 'foundation', 'plistlib' or 'auto', which
+    prefers Foundation and falls back to plistlib if PyObjC can't be imported."""
+    global _plist_backend
+    if name == 'auto':
+        try:
+            _plist_backend = FoundationPlistBackend()
+        except ImportError:
+            _plist_backend = PlistlibPlistBackend()
+    elif name in PLIST_BACKENDS:
+        _plist_backend = PLIST_BACKENDS[name]()
+    else:
+        raise ValueError("Unknown plist backend: %s" % name)
+    return _plist_backend
+
+
+def getPlistBackend():
+    """Return the current plist backend, selecting one automatically if
+    setPlistBackend() hasn't been called yet."""
+    if _plist_backend is None:
+        setPlistBackend()
+    return _plist_backend
+
+
 def readPlist(filepath):
     """
     Read a .plist file from filepath.  Return the unpacked root object
-    (which is usually a dictionary).
+    (which is usually a dictionary). XML and binary plists are both accepted.
     """
-    plistData = NSData.dataWithContentsOfFile_(filepath)
-    dataObject, plistFormat, error = \
-        NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
-                     plistData, NSPropertyListMutableContainers, None, None)
-    if error:
-        error = error.encode('ascii', 'ignore')
-        errmsg = "%s in file %s" % (error, filepath)
-        raise NSPropertyListSerializationException(errmsg)
-    else:
-        return dataObject
+    with timedPhase('plist-decode', path=filepath) as event:
+        if event is not None and os.path.exists(filepath):
+            event['bytes'] = os.path.getsize(filepath)
+        return getPlistBackend().readPlist(filepath)
 
 
 def readPlistFromString(data):
     '''Read a plist data from a string. Return the root object.'''
-    plistData = buffer(data)
-    dataObject, plistFormat, error = \
-     NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
-                    plistData, NSPropertyListMutableContainers, None, None)
-    if error:
-        error = error.encode('ascii', 'ignore')
-        raise NSPropertyListSerializationException(error)
-    else:
-        return dataObject
+    with timedPhase('plist-decode', bytes=len(data)):
+        return getPlistBackend().readPlistFromString(data)
 
 
-def writePlist(dataObject, filepath):
+def writePlist(dataObject, filepath, plist_format='xml'):
     '''
-    Write 'rootObject' as a plist to filepath.
+    Write 'rootObject' as a plist to filepath, in one of PLIST_FORMATS.
     '''
-    plistData, error = \
-     NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
-                            dataObject, NSPropertyListXMLFormat_v1_0, None)
-    if error:
-        error = error.encode('ascii', 'ignore')
-        raise NSPropertyListSerializationException(error)
-    else:
-        if plistData.writeToFile_atomically_(filepath, True):
+    getPlistBackend().writePlist(dataObject, filepath, plist_format)
+
+
+def writePlistToString(dataObject, plist_format='xml'):
+    '''Return 'rootObject' as a plist byte string in one of PLIST_FORMATS.'''
+    return getPlistBackend().writePlistToString(dataObject, plist_format)
+
+
+def _writeFileAtomically(data, filepath):
+    """Write data, either a byte string or an iterable of byte strings, to a
+    temporary file next to filepath and rename it into place, so readers never
+    see a partially-written file."""
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(filepath)),
+                            '.%s.%s.tmp' % (os.path.basename(filepath), os.getpid()))
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            if isinstance(data, bytes):
+                tmp_file.write(data)
+            else:
+                for chunk in data:
+                    tmp_file.write(chunk)
+        os.rename(tmp_path, filepath)
+    except (IOError, OSError):
+        raise NSPropertyListWriteException(
+            "Failed to write plist data to %s" % filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+_XML_PLIST_HEADER = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                     b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+                     b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                     b'<plist version="1.0">\n')
+
+_XML_CONTROL_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _escapeXML(text):
+    if not isinstance(text, type(u'')):
+        text = text.decode('UTF-8')
+    if _XML_CONTROL_CHARS.search(text):
+        raise ValueError("strings can't contain control characters; use bytes instead")
+    text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+    return text.encode('UTF-8')
+
+
+def _iterXMLPlistValue(value, depth):
+    indent = b'\t' * depth
+    if hasattr(value, 'keys'):
+        if not len(value):
+            yield indent + b'<dict/>\n'
             return
-        else:
-            raise NSPropertyListWriteException(
-                                "Failed to write plist data to %s" % filepath)
+        yield indent + b'<dict>\n'
+        for key in sorted(value.keys()):
+            if not isinstance(key, _text_types):
+                raise TypeError("keys must be strings")
+            yield indent + b'\t<key>' + _escapeXML(key) + b'</key>\n'
+            for line in _iterXMLPlistValue(value[key], depth + 1):
+                yield line
+        yield indent + b'</dict>\n'
+    elif isinstance(value, bool):
+        yield indent + (b'<true/>\n' if value else b'<false/>\n')
+    elif isinstance(value, _int_types):
+        if not -1 << 63 <= value < 1 << 64:
+            raise OverflowError(value)
+        yield indent + b'<integer>' + str(value).encode('ascii') + b'</integer>\n'
+    elif isinstance(value, float):
+        yield indent + b'<real>' + repr(value).encode('ascii') + b'</real>\n'
+    elif isinstance(value, _text_types):
+        yield indent + b'<string>' + _escapeXML(value) + b'</string>\n'
+    elif isinstance(value, (bytes, bytearray)) or hasattr(value, 'bytes') or \
+            hasattr(value, 'data'):
+        # Encoded from a view of the value's bytes, so they're never copied whole
+        data = _plistDataView(value)
+        yield indent + b'<data>\n'
+        # Same line length as plistlib, base64-encoding a block of lines at a time
+        maxlinelength = max(16, 76 - 8 * depth)
+        maxbinsize = (maxlinelength // 4) * 3
+        blocksize = maxbinsize * 1024
+        for block in range(0, len(data), blocksize):
+            yield b''.join([indent + binascii.b2a_base64(data[offset:offset + maxbinsize])
+                            for offset in range(block, min(block + blocksize, len(data)),
+                                                maxbinsize)])
+        yield indent + b'</data>\n'
+    elif isinstance(value, datetime.datetime) or hasattr(value, 'timeIntervalSince1970'):
+        if not isinstance(value, datetime.datetime):
+            # NSDate
+            value = datetime.datetime(*time.gmtime(value.timeIntervalSince1970())[0:6])
+        yield indent + (u'<date>%04d-%02d-%02dT%02d:%02d:%02dZ</date>\n' % (
+            value.year, value.month, value.day,
+            value.hour, value.minute, value.second)).encode('ascii')
+    elif isinstance(value, (list, tuple)) or hasattr(value, 'objectAtIndex_'):
+        if not len(value):
+            yield indent + b'<array/>\n'
+            return
+        yield indent + b'<array>\n'
+        for item in value:
+            for line in _iterXMLPlistValue(item, depth + 1):
+                yield line
+        yield indent + b'</array>\n'
+    else:
+        raise TypeError("unsupported type: %s" % type(value))
 
-# End borrowed functions and classes from FoundationPlist.
+
+def iterXMLPlist(rootObject):
+    """Yield the XML plist representation of rootObject as UTF-8 byte strings,
+    one element at a time, in the same layout as Python 3's plistlib."""
+    yield _XML_PLIST_HEADER
+    for line in _iterXMLPlistValue(rootObject, 0):
+        yield line
+    yield b'</plist>\n'
+
+
+def writePlistStreaming(dataObject, filepath):
+    """Write dataObject as an XML plist to filepath without building the whole
+    document in memory first. Like writePlist(), the file is replaced atomically."""
+    try:
+        _writeFileAtomically(iterXMLPlist(dataObject), filepath)
+    except (TypeError, ValueError, OverflowError) as error:
+        raise NSPropertyListSerializationException(str(error))
+
+
+# Match a domain ending in .ByHost, the Ethernet MAC, or the Hardware UUID
+BYHOST_PATTERN = re.compile(r'\.ByHost$|\.[0-9a-fA-F]{12}$|\.[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}$')
 
 
 def getDomainFromPlist(plist_path_or_name):
@@ -264,11 +1478,8 @@ def getDomainFromPlist(plist_path_or_name):
     domain_info = {}
     domain_info['is_byhost'] = False
 
-    # Match a domain ending in .ByHost, the Ethernet MAC, or the Hardware UUID
-    byhost_pattern = re.compile('\.ByHost$|\.[0-9a-fA-F]{12}$|\.[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}$')
-
     plist_file_name = os.path.basename(plist_path_or_name).split('.plist')[0]
-    byhost_match = re.search(byhost_pattern, plist_file_name)
+    byhost_match = BYHOST_PATTERN.search(plist_file_name)
     if byhost_match:
         domain_info['is_byhost'] = True
         domain_info['name'] = '.'.join(plist_file_name.split('.')[0:-1])
@@ -278,49 +1489,536 @@ def getDomainFromPlist(plist_path_or_name):
     return domain_info
 
 
-def getMCXData(ds_object):
-    '''Returns a dictionary representation of dsAttrTypeStandard:MCXSettings
-    from the given DirectoryServices object. This is an array of dicts.'''
+def findPlists(root, extension='.plist'):
+    """Return the paths of all files ending in extension under the directory root,
+    in sorted order, walking the tree with scandir where available."""
+    found = []
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        if scandir is not None:
+            for entry in scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(extension) and entry.is_file():
+                    found.append(entry.path)
+        else:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    pending.append(path)
+                elif name.endswith(extension) and os.path.isfile(path):
+                    found.append(path)
+    return sorted(found)
+
+
+def _readPlistForPool(plist_path):
+    try:
+        return (plist_path, readPlist(plist_path), None)
+    except FoundationPlistException as error:
+        return (plist_path, None, str(error))
+    except EnvironmentError as error:
+        return (plist_path, None, str(error))
+
+
+def _timedWorkerCall(call):
+    """Return func(item) for the (func, item) tuple call in a pool worker, along
+    with the phases recorded while it ran."""
+    global _phase_timer
+    func, item = call
+    _phase_timer = PhaseTimer()
+    try:
+        return func(item), _phase_timer.events
+    finally:
+        _phase_timer = None
+
+
+def mapPlistWorkers(func, items, jobs=1):
+    """Return [func(item) for item in items], spread over a pool of jobs worker
+    processes. Objects created by PyObjC can't be sent between processes, so
+    workers use the plistlib backend when the Foundation backend is selected.
+    Phases timed in the workers are added to this process's timings."""
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    backend = getPlistBackend().name
+    if backend == 'foundation':
+        backend = 'plistlib'
+    pool = multiprocessing.Pool(jobs, initializer=setPlistBackend, initargs=(backend,))
+    chunksize = max(1, len(items) // (jobs * 4))
+    try:
+        if _phase_timer is None:
+            return pool.map(func, items, chunksize=chunksize)
+        results = pool.map(_timedWorkerCall, [(func, item) for item in items], chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    for _, events in results:
+        _phase_timer.events.extend(events)
+    return [result for result, _ in results]
+
+
+def readPlistsInParallel(plist_paths, jobs=1):
+    """Parse the plists at plist_paths using a pool of jobs worker processes and
+    return a list of (path, root object, error message or None) tuples in the same
+    order as plist_paths."""
+    return mapPlistWorkers(_readPlistForPool, plist_paths, jobs)
+
+
+def readProfile(profile_path):
+    """Read a profile like readPlist(). A signed profile is read from the XML
+    plist embedded in its signature, without verifying the signature."""
+    with open(profile_path, 'rb') as profile_file:
+        data = profile_file.read()
+    if data[:len(BINARY_PLIST_MAGIC)] != BINARY_PLIST_MAGIC and not data.lstrip()[:1] == b'<':
+        start = data.find(b'<?xml')
+        end = data.find(b'</plist>', start)
+        if start == -1 or end == -1:
+            raise NSPropertyListSerializationException("No plist found in file %s" % profile_path)
+        data = data[start:end + len(b'</plist>')]
+    try:
+        return readPlistFromString(data)
+    except FoundationPlistException as error:
+        raise NSPropertyListSerializationException("%s in file %s" % (error, profile_path))
+
+
+def summarizeProfile(profile):
+    """Return the top-level identifier, UUID and display name of a profile dict,
+    and a list of (payload UUID, domain, state, keys) tuples for its settings.
+    Payloads other than Custom Settings are listed with their PayloadType as the
+    domain and no state or keys."""
+    settings = []
+    for payload in profile.get('PayloadContent') or []:
+        payload_uuid = payload.get('PayloadUUID')
+        content = payload.get('PayloadContent')
+        if payload.get('PayloadType') != 'com.apple.ManagedClient.preferences' or \
+                not hasattr(content, 'keys'):
+            settings.append((payload_uuid, payload.get('PayloadType'), None, []))
+            continue
+        for domain in content.keys():
+            for state in content[domain].keys():
+                keys = set()
+                for entry in content[domain][state]:
+                    keys.update((entry.get('mcx_preference_settings') or {}).keys())
+                settings.append((payload_uuid, domain, state, sorted(keys)))
+    return (profile.get('PayloadIdentifier'), profile.get('PayloadUUID'),
+            profile.get('PayloadDisplayName'), settings)
+
+
+def _summarizeProfileForPool(profile_path):
+    try:
+        return (profile_path, summarizeProfile(readProfile(profile_path)), None)
+    except (FoundationPlistException, EnvironmentError, AttributeError, TypeError) as error:
+        return (profile_path, None, str(error) or error.__class__.__name__)
+
+
+class ProfileInventory(object):
+    """SQLite index of the profiles under a directory, recording each profile's
+    identifiers and the domains, states and keys it manages. Paths are stored
+    relative to the directory. Updating only reads profiles whose modification
+    time or size has changed since they were indexed."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS profiles (
+            path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+            identifier TEXT, uuid TEXT, displayname TEXT, error TEXT);
+        CREATE TABLE IF NOT EXISTS settings (
+            path TEXT, payload_uuid TEXT, domain TEXT, state TEXT, key TEXT);
+        CREATE INDEX IF NOT EXISTS profiles_identifier ON profiles (identifier);
+        CREATE INDEX IF NOT EXISTS settings_path ON settings (path);
+        CREATE INDEX IF NOT EXISTS settings_domain ON settings (domain);
+        CREATE INDEX IF NOT EXISTS settings_key ON settings (key);
+    """
+
+    def __init__(self, root, db_path):
+        import sqlite3
+        self.root = os.path.abspath(root)
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, jobs=1):
+        """Bring the index up to date with the '.mobileconfig' files under the
+        directory, reading new and changed ones with jobs worker processes.
+        Returns a dict counting the added, updated, removed and unchanged
+        profiles, and the indexed profiles that couldn't be read."""
+        indexed = dict((path, (mtime, size)) for path, mtime, size in
+                       self.db.execute('SELECT path, mtime, size FROM profiles'))
+        found = {}
+        for profile_path in findPlists(self.root, '.mobileconfig'):
+            info = os.stat(profile_path)
+            found[os.path.relpath(profile_path, self.root)] = (info.st_mtime, info.st_size)
+        changed = sorted(path for path, stat in found.items() if indexed.get(path) != stat)
+        removed = [path for path in indexed if path not in found]
+        counts = {'added': len([path for path in changed if path not in indexed]),
+                  'updated': len([path for path in changed if path in indexed]),
+                  'removed': len(removed),
+                  'unchanged': len(found) - len(changed)}
+
+        summaries = mapPlistWorkers(_summarizeProfileForPool,
+                                    [os.path.join(self.root, path) for path in changed], jobs)
+        with self.db:
+            for path in changed + removed:
+                self.db.execute('DELETE FROM profiles WHERE path = ?', (path,))
+                self.db.execute('DELETE FROM settings WHERE path = ?', (path,))
+            for path, (profile_path, summary, error) in zip(changed, summaries):
+                mtime, size = found[path]
+                if error:
+                    self.db.execute('INSERT INTO profiles (path, mtime, size, error) VALUES (?, ?, ?, ?)',
+                                    (path, mtime, size, error))
+                    continue
+                identifier, profile_uuid, displayname, settings = summary
+                self.db.execute('INSERT INTO profiles VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                                (path, mtime, size, identifier, profile_uuid, displayname))
+                self.db.executemany('INSERT INTO settings VALUES (?, ?, ?, ?, ?)',
+                    [(path, payload_uuid, domain, state, key)
+                     for payload_uuid, domain, state, keys in settings
+                     for key in (keys or [None])])
+        counts['errors'] = self.db.execute(
+            'SELECT COUNT(*) FROM profiles WHERE error IS NOT NULL').fetchone()[0]
+        return counts
+
+    def find(self, domain=None, key=None, identifier=None):
+        """Return (path, identifier, domain, state, key) tuples for the indexed
+        settings matching all of the given domain, key and profile identifier.
+        key is None in the results unless a key was given."""
+        conditions = []
+        values = []
+        for column, value in (('s.domain', domain), ('s.key', key), ('p.identifier', identifier)):
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                values.append(value)
+        query = ('SELECT DISTINCT p.path, p.identifier, s.domain, s.state, %s '
+                 'FROM profiles p JOIN settings s ON s.path = p.path' % ('s.key' if key else 'NULL'))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY p.path, s.domain, s.state'
+        return [(os.path.join(self.root, row[0]),) + tuple(row[1:])
+                for row in self.db.execute(query, values)]
+
+    def errors(self):
+        """Return (path, error) tuples for the profiles that couldn't be read."""
+        return [(os.path.join(self.root, path), error) for path, error in
+                self.db.execute('SELECT path, error FROM profiles WHERE error IS NOT NULL ORDER BY path')]
+
+
+DSCL = '/usr/bin/dscl'
+
+
+class DirectoryServicesError(ProfileBuildError):
+    """Raised when dscl fails, times out, or returns unusable data."""
+    pass
+
+
+def splitDSPath(ds_object):
+    """Split a Directory Services path such as /LDAPv3/server/ComputerGroups/foo
+    into its node (/LDAPv3/server) and the path within the node (/ComputerGroups/foo)."""
     ds_object_parts = ds_object.split('/')
     ds_node = '/'.join(ds_object_parts[0:3])
     ds_object_path = '/' + '/'.join(ds_object_parts[3:])
-    cmd = ['/usr/bin/dscl', '-plist', ds_node, 'read', ds_object_path,
-           'dsAttrTypeStandard:MCXSettings']
-    proc = subprocess.Popen(cmd, bufsize=1, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (pliststr, err) = proc.communicate()
-    if proc.returncode:
-        errorAndExit("dscl error: %s" % err)
-
+    return (ds_node, ds_object_path)
+
+
+class DSResponseCache(object):
+    """On-disk cache of dscl output, so that repeated exports don't query the
+    Directory Services node again. Each entry is a file named by a hash of the dscl
+    arguments (which hold the node, record path and attribute), starting with a
+    line holding the time it was fetched. Entries older than ttl seconds are
+    fetched again, and when the entries take more than max_bytes, the least
+    recently used ones are removed. With refresh set, every response is fetched
+    again and stored."""
+
+    def __init__(self, cache_dir, ttl=3600, max_bytes=100 * 1024 * 1024, refresh=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._size = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, args):
+        key = hashlib.sha256('\0'.join(args).encode('UTF-8')).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, args):
+        """Return the cached output of dscl args, or None if it isn't cached, has
+        expired, or refresh is set."""
+        if self.refresh:
+            return None
+        entry_path = self._path(args)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                fetched = float(entry_file.readline())
+                if time.time() - fetched > self.ttl:
+                    return None
+                out = entry_file.read()
+            # The modification time records the last use, for eviction
+            os.utime(entry_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return out
+
+    def put(self, args, out):
+        """Store out as the output of dscl args, then evict entries if the cache
+        has grown past max_bytes."""
+        entry_path = self._path(args)
+        entry = ('%f\n' % time.time()).encode('ascii') + out
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for path, mtime, size in self._entries())
+            elif os.path.exists(entry_path):
+                self._size -= os.path.getsize(entry_path)
+            _writeFileAtomically(entry, entry_path)
+            self._size += len(entry)
+            if self._size > self.max_bytes:
+                self._evict(keep=entry_path)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, info.st_mtime, info.st_size))
+        return entries
+
+    def _evict(self, keep):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for path, mtime, size in entries)
+        for path, mtime, size in entries:
+            if self._size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+
+# Popen() arguments running a command in a session of its own, so that its whole
+# process group can be killed
+if sys.version_info[0] < 3:
+    _NEW_SESSION = {'preexec_fn': os.setsid}
+else:
+    _NEW_SESSION = {'start_new_session': True}
+
+
+def runDscl(args, dscl=DSCL, timeout=None, retries=0, cache=None):
+    """Run dscl with args and return its standard output. dscl is the path of the
+    dscl executable, so a stand-in can be used for testing. The command is killed
+    after timeout seconds, and retried up to retries more times if it fails. If
+    cache is a DSResponseCache, a cached response is returned when there is one,
+    and successful responses are stored in it."""
+    if cache is not None:
+        with timedPhase('dscl-cache', args=list(args)) as event:
+            out = cache.get(args)
+            if event is not None:
+                event['hit'] = out is not None
+                if out is not None:
+                    event['bytes'] = len(out)
+        if out is not None:
+            return out
+    cmd = [dscl] + list(args)
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(0.5 * attempt)
+        with timedPhase('dscl', args=list(args), attempt=attempt) as event:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, **_NEW_SESSION)
+            timed_out = []
+            timer = None
+            if timeout:
+                def kill():
+                    timed_out.append(True)
+                    # Kill anything dscl started too, which could hold its output open
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+            try:
+                (out, err) = proc.communicate()
+            finally:
+                if timer:
+                    timer.cancel()
+            if event is not None:
+                event['bytes'] = len(out)
+        if timed_out:
+            errmsg = "dscl timed out after %s seconds: %s" % (timeout, ' '.join(cmd))
+        elif proc.returncode:
+            errmsg = "dscl error: %s" % err.decode('UTF-8', 'replace').strip()
+        else:
+            if cache is not None:
+                cache.put(args, out)
+            return out
+    raise DirectoryServicesError(errmsg)
+
+
+def _mentionsDomain(mcx_item, domains):
+    """Return False if the XML plist text mcx_item can't contain a key for any of
+    domains, without decoding it. Binary plists can't be checked, and return True."""
+    if isinstance(mcx_item, bytes):
+        if mcx_item[:len(BINARY_PLIST_MAGIC)] == BINARY_PLIST_MAGIC:
+            return True
+        return any(b'<key>' + _escapeXML(domain) + b'</key>' in mcx_item for domain in domains)
+    return any(u'<key>%s</key>' % _escapeXML(domain).decode('UTF-8') in mcx_item
+               for domain in domains)
+
+
+def iterMCXItems(mcx_data_plist, domains=None):
+    """Decode the items of an MCXSettings array one at a time, yielding each
+    item's mcx_application_data dict. With a list of domains, only those domains
+    are kept, and items that don't mention any of them aren't decoded at all."""
+    for mcx_item in mcx_data_plist:
+        if domains and not _mentionsDomain(mcx_item, domains):
+            continue
+        try:
+            if not isinstance(mcx_item, bytes):
+                mcx_item = mcx_item.encode('UTF-8')
+            mcx_item_data = readPlistFromString(mcx_item)
+            mcx_application_data = mcx_item_data['mcx_application_data']
+        except (KeyError, FoundationPlistException):
+            raise DirectoryServicesError(
+                "Unexpected mcx_settings format in MCXSettings array item:\n%s" % mcx_item)
+        if domains:
+            mcx_application_data = dict((domain, mcx_application_data[domain])
+                                        for domain in domains if domain in mcx_application_data)
+            if not mcx_application_data:
+                continue
+        yield mcx_application_data
+
+
+def _outputText(data):
+    """Return a command's output bytes as a native string for use in messages."""
+    if sys.version_info[0] < 3:
+        return data
+    return data.decode('UTF-8', 'replace')
+
+
+def parseMCXSettings(pliststr, domains=None):
+    """Return an iterator over the mcx_application_data dicts decoded from the
+    output of 'dscl -plist read <path> MCXSettings', or None if the record has no
+    MCXSettings. Items are decoded as the iterator advances; see iterMCXItems()
+    for domains."""
     # decode plist string returned by dscl
     try:
         mcx_dict = readPlistFromString(pliststr)
     except FoundationPlistException:
-        errorAndExit(
-            "Could not decode plist data from dscl:\n" % pliststr)
+        raise DirectoryServicesError(
+            "Could not decode plist data from dscl:\n%s" % _outputText(pliststr))
 
     # mcx_settings is a plist encoded inside the plist!
+    if 'dsAttrTypeStandard:MCXSettings' not in mcx_dict:
+        return None
+    return iterMCXItems(mcx_dict['dsAttrTypeStandard:MCXSettings'], domains)
+
+
+def fetchMCXSettings(ds_object, dscl=DSCL, timeout=None, retries=0, cache=None):
+    """Return the raw 'dscl -plist read' output for the MCXSettings of ds_object."""
+    ds_node, ds_object_path = splitDSPath(ds_object)
+    return runDscl(['-plist', ds_node, 'read', ds_object_path,
+                    'dsAttrTypeStandard:MCXSettings'],
+                   dscl=dscl, timeout=timeout, retries=retries, cache=cache)
+
+
+def getMCXData(ds_object, dscl=DSCL, timeout=None, retries=0, cache=None, domains=None):
+    '''Returns a dictionary representation of dsAttrTypeStandard:MCXSettings
+    from the given DirectoryServices object. This is an iterator over dicts,
+    decoded as it advances, and limited to domains if given.'''
     try:
-        mcx_data_plist = mcx_dict['dsAttrTypeStandard:MCXSettings']
-    except KeyError:
-        errorAndExit("No mcx_settings in %s:\n%s" % (ds_object, pliststr))
+        pliststr = fetchMCXSettings(ds_object, dscl=dscl, timeout=timeout, retries=retries,
+                                    cache=cache)
+        mcx_data = parseMCXSettings(pliststr, domains)
+    except DirectoryServicesError as error:
+        errorAndExit(str(error))
+    if mcx_data is None:
+        errorAndExit("No mcx_settings in %s:\n%s" % (ds_object, _outputText(pliststr)))
+    return mcx_data
 
-    mcx_data = []
-    # build a list containing domains' mcx_application_data dict
-    for mcx_item in mcx_data_plist:
+
+def listDSRecords(ds_path, dscl=DSCL, timeout=None, retries=0, cache=None):
+    """Return the names of the records under a Directory Services path such as
+    /LDAPv3/server/ComputerGroups."""
+    ds_node, ds_object_path = splitDSPath(ds_path)
+    out = runDscl([ds_node, 'list', ds_object_path],
+                  dscl=dscl, timeout=timeout, retries=retries, cache=cache)
+    return [line.strip() for line in out.decode('UTF-8').splitlines() if line.strip()]
+
+
+def exportDSNode(ds_path, identifier, output_dir, concurrency=8, dscl=DSCL,
+                 timeout=None, retries=0, removal_allowed=False,
+                 organization='', displayname='', deterministic=False, streaming=False,
+                 output_format='xml', cache=None):
+    """Write one profile for each record under ds_path that has MCXSettings.
+    Records are fetched by up to concurrency dscl processes at once; profiles are
+    named '<identifier>.<record name>'. cache is an optional DSResponseCache.
+    Returns a list of (record name, error) tuples for the records that couldn't
+    be exported."""
+    records = listDSRecords(ds_path, dscl=dscl, timeout=timeout, retries=retries, cache=cache)
+
+    def fetch(record):
         try:
-            mcx_item = mcx_item.encode('UTF-8')
-            mcx_item_data = readPlistFromString(str(mcx_item))
-            mcx_data.append(mcx_item_data['mcx_application_data'])
-        except KeyError:
-            errorAndExit(
-                "Unexpected mcx_settings format in MCXSettings array item:\n%s" % mcx_item)
+            return (record, fetchMCXSettings(ds_path.rstrip('/') + '/' + record,
+                    dscl=dscl, timeout=timeout, retries=retries, cache=cache), None)
+        except DirectoryServicesError as error:
+            return (record, None, str(error))
+
+    failures = []
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        # dscl runs concurrently, decoding and saving happen here in record order
+        for record, pliststr, errmsg in pool.imap(fetch, records):
+            try:
+                if errmsg:
+                    raise DirectoryServicesError(errmsg)
+                mcx_data = list(parseMCXSettings(pliststr) or [])
+                if not mcx_data:
+                    print("Skipping %s: no MCXSettings" % record)
+                    continue
+                record_identifier = '%s.%s' % (identifier, record)
+                profile = PayloadDict(identifier=record_identifier,
+                    removal_allowed=removal_allowed,
+                    organization=organization,
+                    displayname=displayname,
+                    deterministic=deterministic)
+                for mcx_domain in mcx_data:
+                    profile.addPayloadFromMCX(mcx_domain)
+                output_file = os.path.join(output_dir,
+                    record_identifier.replace('/', '_') + '.mobileconfig')
+                profile.finalizeAndSave(output_file, streaming=streaming,
+                                        output_format=output_format)
+                print("Exported %s to %s" % (record, output_file))
+            except (ProfileBuildError, FoundationPlistException) as error:
+                print("Error exporting %s: %s" % (record, error), file=sys.stderr)
+                failures.append((record, str(error)))
+    finally:
+        pool.close()
+        pool.join()
+    return failures
 
-    return mcx_data
 
 def getDefaultsData(app_id, current_host, any_user):
     '''Returns the content of the defaults domain as an array or dict obejct.'''
 
+    try:
+        from Foundation import CFPreferencesCopyKeyList, \
+                               CFPreferencesCopyMultiple, \
+                               kCFPreferencesCurrentUser, \
+                               kCFPreferencesAnyUser, \
+                               kCFPreferencesCurrentHost, \
+                               kCFPreferencesAnyHost, \
+                               kCFPreferencesAnyApplication
+    except ImportError:
+        errorAndExit("Error: the '--defaults' option requires PyObjC's Foundation module.")
+
     if app_id == "NSGlobalDomain":
         app_id = kCFPreferencesAnyApplication
 
@@ -334,8 +2032,9 @@ def getDefaultsData(app_id, current_host, any_user):
     else:
         user_domain = kCFPreferencesCurrentUser
 
-    allKeys = CFPreferencesCopyKeyList(app_id, user_domain, host_domain)
-    prefs_dict = CFPreferencesCopyMultiple(allKeys, app_id, user_domain, host_domain)
+    with timedPhase('cfpreferences', app_id=str(app_id)):
+        allKeys = CFPreferencesCopyKeyList(app_id, user_domain, host_domain)
+        prefs_dict = CFPreferencesCopyMultiple(allKeys, app_id, user_domain, host_domain)
 
     if len(prefs_dict) == 0:
         errorAndExit("Error: no values found for app id: %s" % app_id)
@@ -343,6 +2042,151 @@ def getDefaultsData(app_id, current_host, any_user):
     return prefs_dict
 
 
+# Name of the plist in which CFPreferences stores the NSGlobalDomain preferences
+GLOBAL_PREFERENCES_NAME = '.GlobalPreferences'
+
+
+def findPreferencePlists(root):
+    """Return (path, domain, is_byhost) tuples for the preference plists in root,
+    which is either a Library/Preferences directory or a home directory or volume
+    containing one. As with CFPreferences, only plists directly in the directory and
+    in its ByHost subdirectory are included. Domains are named by getDomainFromPlist(),
+    except that '.GlobalPreferences' is named NSGlobalDomain as with '--defaults'."""
+    prefs_dir = os.path.join(root, 'Library', 'Preferences')
+    if not os.path.isdir(prefs_dir):
+        prefs_dir = root
+    found = []
+    for directory, in_byhost in ((prefs_dir, False), (os.path.join(prefs_dir, 'ByHost'), True)):
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.endswith('.plist') or not os.path.isfile(path):
+                continue
+            domain_info = getDomainFromPlist(path)
+            domain = domain_info['name']
+            if domain == GLOBAL_PREFERENCES_NAME:
+                domain = 'NSGlobalDomain'
+            found.append((path, domain, in_byhost or domain_info['is_byhost']))
+    return found
+
+
+def harvestPreferences(roots, jobs=1):
+    """Read the preference plists found by findPreferencePlists() in each of roots
+    using a pool of jobs worker processes. Returns a list of (path, domain, is_byhost,
+    preferences) tuples, in the order of roots and then of file names, and a list of
+    (path, error message) tuples for the plists that couldn't be read. Plists without
+    any preferences are left out."""
+    found = []
+    for root in roots:
+        found.extend(findPreferencePlists(root))
+    harvested = []
+    errors = []
+    results = readPlistsInParallel([path for path, _, _ in found], jobs)
+    for (path, domain, is_byhost), (_, preferences, errmsg) in zip(found, results):
+        if errmsg:
+            errors.append((path, errmsg))
+        elif preferences:
+            harvested.append((path, domain, is_byhost, preferences))
+    return harvested, errors
+
+
+def exportHarvest(harvested, identifier, output_dir, manage, removal_allowed=False,
+                  organization='', displayname='', deterministic=False, merge_domains=False,
+                  merge_conflicts='last', collapse_subtrees=False, streaming=False,
+                  output_format='xml'):
+    """Write one profile for each domain in harvested, as returned by
+    harvestPreferences(), with a payload for each of the domain's plists. Profiles
+    are named '<identifier>.<domain>', and include the domain's ByHost preferences.
+    Returns a list of (domain, error) tuples for the profiles that couldn't be written."""
+    by_domain = collections.OrderedDict()
+    for _, domain, is_byhost, preferences in harvested:
+        by_domain.setdefault(domain, []).append((preferences, is_byhost))
+    failures = []
+    for domain, domain_preferences in by_domain.items():
+        domain_identifier = '%s.%s' % (identifier, domain)
+        try:
+            profile = PayloadDict(identifier=domain_identifier,
+                removal_allowed=removal_allowed,
+                organization=organization,
+                displayname=displayname,
+                deterministic=deterministic,
+                merge_domains=merge_domains,
+                merge_conflicts=merge_conflicts)
+            for preferences, is_byhost in domain_preferences:
+                profile.addPayloadFromPlistContents(preferences, domain, manage, is_byhost)
+            if collapse_subtrees:
+                profile.collapseDuplicateSubtrees()
+            output_file = os.path.join(output_dir, domain_identifier + '.mobileconfig')
+            profile.finalizeAndSave(output_file, streaming=streaming,
+                                    output_format=output_format)
+            print("Exported %s to %s" % (domain, output_file))
+        except (ProfileBuildError, FoundationPlistException) as error:
+            print("Error exporting %s: %s" % (domain, error), file=sys.stderr)
+            failures.append((domain, str(error)))
+    return failures
+
+
+def printSizeReport(unmerged, profile, plist_format='xml', limit=10):
+    """Print the serialized size of profile next to that of unmerged, the same
+    profile built without merging or collapsing, followed by the limit largest
+    duplicated subtrees in profile."""
+    before = len(writePlistToString(unmerged.data, plist_format))
+    after = len(writePlistToString(profile.data, plist_format))
+    print("Size report (%s):" % plist_format)
+    print("  Before: %d payloads, %d bytes" % (len(unmerged.data['PayloadContent']), before))
+    print("  After:  %d payloads, %d bytes (%+.1f%%)" % (
+        len(profile.data['PayloadContent']), after,
+        100.0 * (after - before) / before if before else 0))
+    if profile.merged_payloads:
+        print("  Inputs merged into an earlier payload for the same domain and state: %d" %
+              profile.merged_payloads)
+    duplicates = findDuplicateSubtrees(profile.data['PayloadContent'])
+    if duplicates:
+        print("Duplicated subtrees (largest savings first):")
+        for duplicate in duplicates[:limit]:
+            print("  %d copies of %d bytes: %s" % (duplicate['count'], duplicate['bytes'],
+                                                   ', '.join(duplicate['paths'])))
+        if len(duplicates) > limit:
+            print("  ... and %d more" % (len(duplicates) - limit))
+
+
+def _describeValue(value):
+    if hasattr(value, 'keys') and 'PayloadType' in value:
+        return '<%s payload>' % value['PayloadType']
+    if hasattr(value, 'keys'):
+        return '<dict of %d keys>' % len(value)
+    if _isPlistArray(value):
+        return '<array of %d items>' % len(value)
+    data = _plistDataView(value)
+    if data is not None:
+        return '<%d bytes of data>' % len(data)
+    if isinstance(value, _text_types):
+        text = '"%s"' % value
+    else:
+        text = str(value)
+    if len(text) > 60:
+        text = text[:57] + '...'
+    return text
+
+
+def printProfileDiff(changes, existing_path):
+    """Print the changes returned by diffProfiles(), one per line."""
+    if not changes:
+        print("No changes from %s" % existing_path)
+        return
+    print("Changes from %s:" % existing_path)
+    for change, path, old, new in changes:
+        path = '/'.join(str(part) for part in path)
+        if change == '+':
+            print("  + %s: %s" % (path, _describeValue(new)))
+        elif change == '-':
+            print("  - %s: %s" % (path, _describeValue(old)))
+        else:
+            print("  ~ %s: %s -> %s" % (path, _describeValue(old), _describeValue(new)))
+    print("%d changes" % len(changes))
+
+
 def getIdentifierFromProfile(profile_path):
     """Return a tuple containing the PayloadIdentifier and PayloadUUID from the
     profile at the path specified."""
@@ -355,12 +2199,826 @@ def getIdentifierFromProfile(profile_path):
     return (profile_id, profile_uuid)
 
 
-def main():
+def addPlistPayloads(profile, plist_paths, manage, plist_cache=None):
+    """Read each plist in plist_paths and add its contents to profile as a
+    payload, using the plist's file name as the preference domain. If plist_cache
+    is a dict, plists already in it aren't read again, and newly read ones are added."""
+    for plist_path in plist_paths:
+        if plist_cache is not None and plist_path in plist_cache:
+            source_data = plist_cache[plist_path]
+        else:
+            if not os.path.exists(plist_path):
+                raise ProfileBuildError("No plist file exists at %s" % plist_path)
+            try:
+                source_data = readPlist(plist_path)
+            except FoundationPlistException as error:
+                raise ProfileBuildError("Error decoding plist data in file %s: %s" % (plist_path, error))
+            if plist_cache is not None:
+                plist_cache[plist_path] = source_data
+
+        source_domain = getDomainFromPlist(plist_path)
+        profile.addPayloadFromPlistContents(source_data,
+            source_domain['name'],
+            manage,
+            is_byhost=source_domain['is_byhost'])
+
+
+MANIFEST_FIELDS = ('identifier', 'plists', 'manage', 'output', 'organization',
+                   'removal-allowed', 'displayname')
+
+
+def _manifestBool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def readManifest(manifest_path, defaults=None):
+    """Return a list of profile specs from a JSON or CSV manifest. A JSON manifest
+    is an array of objects, a CSV manifest has a header row; both use the keys in
+    MANIFEST_FIELDS. In CSV, multiple plists are separated by ';'. Relative paths
+    are resolved against the manifest's directory, and missing fields are taken
+    from the defaults dict."""
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    try:
+        with open(manifest_path) as manifest_file:
+            if manifest_path.lower().endswith('.csv'):
+                entries = list(csv.DictReader(manifest_file))
+                for entry in entries:
+                    entry['plists'] = [p for p in (entry.get('plists') or '').split(';') if p]
+            else:
+                entries = json.load(manifest_file)
+    except (IOError, OSError, ValueError) as error:
+        raise ProfileBuildError("Error reading manifest %s: %s" % (manifest_path, error))
+    if not isinstance(entries, list):
+        raise ProfileBuildError("Manifest %s must contain a list of profiles" % manifest_path)
+
+    specs = []
+    for index, entry in enumerate(entries):
+        spec = dict(defaults or {})
+        spec.update((k, v) for k, v in entry.items() if k in MANIFEST_FIELDS and v not in (None, ''))
+        if not spec.get('identifier'):
+            raise ProfileBuildError("Manifest entry %d has no identifier" % (index + 1))
+        if isinstance(spec.get('plists'), (str, type(u''))):
+            spec['plists'] = [spec['plists']]
+        if not spec.get('plists'):
+            raise ProfileBuildError("Manifest entry for %s has no plists" % spec['identifier'])
+        spec['plists'] = [os.path.join(manifest_dir, p) for p in spec['plists']]
+        spec['manage'] = (spec.get('manage') or 'Always').capitalize()
+        spec['removal-allowed'] = _manifestBool(spec.get('removal-allowed', False))
+        if spec.get('output'):
+            spec['output'] = os.path.join(manifest_dir, spec['output'])
+        else:
+            spec['output'] = os.path.join(os.getcwd(), spec['identifier'] + '.mobileconfig')
+        specs.append(spec)
+    return specs
+
+
+def getProfileSpecSettings(options):
+    """Return the settings of a profile spec, as used by buildManifestProfile(),
+    that are given by command-line options."""
+    return {'organization': options.organization,
+            'removal-allowed': options.removal_allowed,
+            'displayname': options.displayname,
+            'deterministic': options.deterministic,
+            'stream-output': options.stream_output,
+            'output-format': options.output_format,
+            'merge-domains': options.merge_domains,
+            'merge-conflicts': options.merge_conflicts,
+            'collapse-subtrees': options.collapse_subtrees,
+            'cache-dir': options.cache_dir and os.path.abspath(options.cache_dir)}
+
+
+# Profile spec keys that don't change the profile built, left out of cache keys
+CACHE_KEY_IGNORED_SETTINGS = ('plists', 'plist-dirs', 'cache-dir', 'stream-output')
+
+
+def getPlistProfileCacheKey(cache, spec):
+    """Return the BuildCache key for the profile described by spec, or None if
+    an input can't be read (the build will report it)."""
+    plist_paths = spec['plists']
+    settings = dict((k, v) for k, v in spec.items() if k not in CACHE_KEY_IGNORED_SETTINGS)
+    settings.update(output=os.path.abspath(spec['output']), gitrev=getGitRevision(),
+                    backend=getPlistBackend().name)
+    try:
+        return cache.key(plist_paths, settings)
+    except EnvironmentError:
+        return None
+
+
+def buildManifestProfile(spec, plist_cache=None):
+    """Build and save the profile described by one manifest spec. Returns a dict
+    with the identifier, output path, elapsed seconds, and an error message or
+    None, so that one bad profile doesn't stop the rest of the batch. plist_cache
+    is passed on to addPlistPayloads()."""
+    start = time.time()
+    result = {'identifier': spec['identifier'], 'output': spec['output'], 'error': None,
+              'skipped': False}
+    try:
+        cache_key = None
+        if spec.get('cache-dir'):
+            cache = BuildCache(spec['cache-dir'])
+            cache_key = getPlistProfileCacheKey(cache, spec)
+            if cache_key and cache.isFresh(cache_key, spec['output']):
+                result['skipped'] = True
+                result['seconds'] = time.time() - start
+                return result
+        profile = PayloadDict(identifier=spec['identifier'],
+            uuid=spec.get('uuid', False),
+            removal_allowed=spec['removal-allowed'],
+            organization=spec.get('organization', ''),
+            displayname=spec.get('displayname', ''),
+            deterministic=spec.get('deterministic', False),
+            merge_domains=spec.get('merge-domains', False),
+            merge_conflicts=spec.get('merge-conflicts') or 'last')
+        addPlistPayloads(profile, spec['plists'], spec['manage'], plist_cache)
+        if spec.get('collapse-subtrees'):
+            profile.collapseDuplicateSubtrees()
+        profile.finalizeAndSave(spec['output'],
+            streaming=spec.get('stream-output', False),
+            output_format=spec.get('output-format', 'xml'))
+        if cache_key:
+            cache.record(cache_key, spec['output'])
+    except (ProfileBuildError, FoundationPlistException, EnvironmentError) as error:
+        result['error'] = str(error)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def buildManifest(specs, jobs=1):
+    """Build every profile in specs, spreading them over a pool of jobs worker
+    processes as in mapPlistWorkers(). Returns the list of buildManifestProfile()
+    results in manifest order."""
+    return mapPlistWorkers(buildManifestProfile, specs, jobs)
+
+
+# A template CSV column in any string of a templated profile, such as '{{hostname}}'
+TEMPLATE_PLACEHOLDER = re.compile(r'\{\{([^{}<>&]+)\}\}')
+
+
+def fillTemplate(text, row):
+    """Return text with each placeholder replaced by its column's value in the row dict."""
+    return TEMPLATE_PLACEHOLDER.sub(lambda match: row[match.group(1)], text)
+
+
+# The date of a 'Once' payload's timestamp in a profile serialized by iterXMLPlist()
+TEMPLATE_TIMESTAMP = re.compile(r'(<key>mcx_data_timestamp</key>\s*<date>)([^<]*)(</date>)')
+
+
+class ProfileTemplate(object):
+    """A profile whose strings contain placeholders for the columns of a template CSV,
+    serialized once as XML. The XML is kept as static fragments between holes for the
+    placeholders and the profile's UUIDs, so that a profile is rendered for each row by
+    encoding only its values and new UUIDs."""
+
+    def __init__(self, profile, deterministic=False):
+        data = profile.data
+        key = self._findPlaceholderKey(data)
+        if key is not None:
+            # Dicts are serialized in key order, which a key's value could change
+            raise ProfileBuildError("Placeholders can't be used in dictionary keys, "
+                                    "such as '%s'" % key)
+        self.identifier = data['PayloadIdentifier']
+        self.deterministic = deterministic
+        # The profile UUID comes first, and also appears in each payload's identifier
+        self.uuids = [data['PayloadUUID']] + [payload['PayloadUUID'] for payload in data['PayloadContent']]
+        xml = b''.join(iterXMLPlist(data)).decode('UTF-8')
+        for index, uuid in enumerate(self.uuids):
+            xml = xml.replace(uuid, '{{#%d}}' % index)
+        # Deterministic 'Once' timestamps are derived again from each row's values
+        self.timestamps = []
+        if deterministic:
+            def timestampHole(match):
+                self.timestamps.append(match.group(2))
+                return '%s{{@%d}}%s' % (match.group(1), len(self.timestamps) - 1, match.group(3))
+            xml = TEMPLATE_TIMESTAMP.sub(timestampHole, xml)
+        parts = TEMPLATE_PLACEHOLDER.split(xml)
+        self.fragments = [part.encode('UTF-8') for part in parts[0::2]]
+        self.holes = []
+        for hole in parts[1::2]:
+            if hole.startswith('#'):
+                self.holes.append(int(hole[1:]))
+            elif hole.startswith('@'):
+                self.holes.append(('@', int(hole[1:])))
+            else:
+                self.holes.append(hole)
+        self.columns = sorted(set(hole for hole in self.holes if isinstance(hole, _text_types)) |
+                              set(TEMPLATE_PLACEHOLDER.findall(self.identifier)))
+
+    @classmethod
+    def _findPlaceholderKey(cls, obj):
+        """Return the first dict key in the plist object obj containing a placeholder, or None."""
+        if hasattr(obj, 'keys'):
+            for key, value in obj.items():
+                if TEMPLATE_PLACEHOLDER.search(key):
+                    return key
+                found = cls._findPlaceholderKey(value)
+                if found is not None:
+                    return found
+        elif isinstance(obj, (list, tuple)):
+            for item in obj:
+                found = cls._findPlaceholderKey(item)
+                if found is not None:
+                    return found
+        return None
+
+    def _rowUUIDs(self, row):
+        if not self.deterministic:
+            return [makeNewUUID() for _ in self.uuids]
+        # As with PayloadDict, derived from the identifier and each payload's
+        # contents, here the template payload and the row's values
+        identifier = fillTemplate(self.identifier, row)
+        values = [row[column] for column in self.columns]
+        return [makeDeterministicUUID(identifier)] + \
+               [makeDeterministicUUID(identifier, uuid, *values) for uuid in self.uuids[1:]]
+
+    def render(self, row):
+        """Return the profile for the row dict as a list of XML byte strings.
+        Raises KeyError for a missing column, and ValueError for a value that
+        can't be stored in a plist string."""
+        uuids = [uuid.encode('ascii') for uuid in self._rowUUIDs(row)]
+        values = [row[column] for column in self.columns]
+        chunks = [self.fragments[0]]
+        for hole, fragment in zip(self.holes, self.fragments[1:]):
+            if isinstance(hole, int):
+                chunks.append(uuids[hole])
+            elif isinstance(hole, tuple):
+                seconds = deterministicTimestampSeconds(
+                    canonicalHash([self.timestamps[hole[1]]] + values))
+                chunks.append(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds)).encode('ascii'))
+            else:
+                chunks.append(_escapeXML(row[hole]))
+            chunks.append(fragment)
+        return chunks
+
+
+def _treeContaining(path, roots):
+    """Return the directory in roots that path is in or under, or None."""
+    for root in roots:
+        if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+            return root
+    return None
+
+
+class InotifyWatcher(object):
+    """Reports changed files using Linux inotify through ctypes. The directories
+    containing the watched files are monitored, so that files replaced by a
+    rename (as many editors and 'git checkout' do) are still noticed. Directory
+    trees in trees are monitored as a whole, and reported when a plist or
+    subdirectory is created, deleted or moved anywhere in them."""
+
+    # from <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, paths, trees=()):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.paths = set()
+        self.trees = list(trees)
+        self.dirs = {}
+        self.watched = set()
+        try:
+            for tree in self.trees:
+                self._watchTree(tree)
+            self.setPaths(paths)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _watch(self, directory):
+        if directory in self.watched:
+            return
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode('UTF-8'), mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), "Can't watch %s" % directory)
+        self.dirs[wd] = directory
+        self.watched.add(directory)
+
+    def _watchTree(self, root):
+        for directory, _, _ in os.walk(root):
+            self._watch(directory)
+
+    def setPaths(self, paths):
+        """Watch paths instead of the files watched so far."""
+        self.paths = set(paths)
+        for directory in set(os.path.dirname(p) for p in self.paths):
+            self._watch(directory)
+
+    def wait(self, timeout):
+        """Return the set of watched paths and trees that changed within timeout seconds."""
+        changed = set()
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return changed
+        buf = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+            offset += self.EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode('UTF-8')
+            offset += length
+            path = os.path.join(self.dirs.get(wd, ''), name)
+            if path in self.paths:
+                changed.add(path)
+            tree = _treeContaining(path, self.trees)
+            if tree and mask & (self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO) \
+            and (mask & self.IN_ISDIR or name.endswith('.plist')):
+                changed.add(tree)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        self._watchTree(path)
+                    except OSError:
+                        pass
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Reports changed files by comparing their modification time, size and inode
+    every interval seconds, and directory trees in trees when the set of plists
+    found in them changes. Used where inotify isn't available."""
+
+    def __init__(self, paths, interval=1.0, trees=()):
+        self.interval = interval
+        self.states = {}
+        self.tree_states = dict((tree, self._treeState(tree)) for tree in trees)
+        self.setPaths(paths)
+
+    def _state(self, path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size, info.st_ino)
+
+    def _treeState(self, tree):
+        try:
+            return tuple(findPlists(tree))
+        except OSError:
+            return None
+
+    def setPaths(self, paths):
+        """Watch paths instead of the files watched so far."""
+        self.states = dict((path, self.states[path] if path in self.states else self._state(path))
+                           for path in paths)
+
+    def wait(self, timeout):
+        """Return the set of watched paths and trees that changed within timeout seconds."""
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        for path, state in self.states.items():
+            new_state = self._state(path)
+            if new_state != state:
+                self.states[path] = new_state
+                changed.add(path)
+        for tree, state in self.tree_states.items():
+            new_state = self._treeState(tree)
+            if new_state != state:
+                self.tree_states[tree] = new_state
+                changed.add(tree)
+        return changed
+
+    def close(self):
+        pass
+
+
+def makeWatcher(paths, use_inotify=True, poll_interval=1.0, trees=()):
+    """Return an InotifyWatcher for paths and trees if possible, otherwise a PollingWatcher."""
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths, trees)
+        except OSError:
+            pass
+    return PollingWatcher(paths, poll_interval, trees)
+
+
+def printBuildResult(result):
+    if result['error']:
+        print("Error building %s: %s" % (result['identifier'], result['error']), file=sys.stderr)
+    elif result['skipped']:
+        print("%s is unchanged, skipping." % result['output'])
+    else:
+        print("Built %s in %.3f seconds" % (result['output'], result['seconds']))
+    sys.stdout.flush()
+
+
+def watchProfiles(specs, debounce=0.5, poll_interval=1.0, use_inotify=True, stop_event=None,
+                  plist_cache=None):
+    """Build the profiles described by specs (as returned by readManifest()), then
+    watch their source plists and rebuild the profiles that use a plist whenever
+    it changes. Only changed plists are parsed again. Changes are collected until
+    none have arrived for debounce seconds. Runs until stop_event is set, if given.
+    plist_cache may map plist paths to contents that have already been read.
+
+    A spec may also list directories in 'plist-dirs', whose plists are among its
+    'plists' as with '--plist-dir'. They are searched again when plists are
+    added to or removed from them, and unreadable plists found in them are
+    skipped with a warning."""
+    specs = [dict(spec, plists=[os.path.abspath(p) for p in spec['plists']],
+                  **{'plist-dirs': [os.path.abspath(d) for d in spec.get('plist-dirs') or ()]})
+             for spec in specs]
+    plist_cache = dict((os.path.abspath(path), source_data)
+                       for path, source_data in (plist_cache or {}).items())
+    # The plists of each spec given other than by its directories, and the plists
+    # in the directories skipped as unreadable, so they're only reported once
+    explicit = {}
+    skipped = set()
+    tree_dependents = {}
+    for index, spec in enumerate(specs):
+        if spec['plist-dirs']:
+            explicit[index] = [p for p in spec['plists']
+                               if not _treeContaining(p, spec['plist-dirs'])]
+            for root in spec['plist-dirs']:
+                tree_dependents.setdefault(root, []).append(index)
+                skipped.update(p for p in findPlists(root) if p not in spec['plists'])
+
+    def indexDependents():
+        dependents = {}
+        for index, spec in enumerate(specs):
+            for path in spec['plists']:
+                dependents.setdefault(path, []).append(index)
+        return dependents
+
+    def rescan(index):
+        spec = specs[index]
+        plists = list(explicit[index])
+        for root in spec['plist-dirs']:
+            found = findPlists(root) if os.path.isdir(root) else []
+            for path in found:
+                if path not in plist_cache:
+                    try:
+                        plist_cache[path] = readPlist(path)
+                    except FoundationPlistException as error:
+                        if path not in skipped:
+                            print("WARNING: Skipping %s: %s" % (path, error), file=sys.stderr)
+                            skipped.add(path)
+                        continue
+                plists.append(path)
+        spec['plists'] = plists
+
+    dependents = indexDependents()
+    for spec in specs:
+        printBuildResult(buildManifestProfile(spec, plist_cache))
+
+    watcher = makeWatcher(dependents.keys(), use_inotify, poll_interval, tree_dependents.keys())
+    print("Watching %d plists for %d profiles using %s" % (
+        len(dependents), len(specs), watcher.__class__.__name__))
+    sys.stdout.flush()
+    pending = set()
+    last_change = 0
+    try:
+        while not (stop_event and stop_event.is_set()):
+            changed = watcher.wait(debounce if pending else poll_interval)
+            if changed:
+                pending.update(changed)
+                last_change = time.time()
+            elif pending and time.time() - last_change >= debounce:
+                for path in pending:
+                    plist_cache.pop(path, None)
+                    skipped.discard(path)
+                affected = set(i for path in pending for i in dependents.get(path, ()))
+                rescanned = set(i for path in pending for i in tree_dependents.get(path, ()))
+                # A changed plist in a directory may have become unreadable, or readable
+                rescanned.update(i for i in affected if i in explicit)
+                pending = set()
+                if rescanned:
+                    for index in rescanned:
+                        rescan(index)
+                    dependents = indexDependents()
+                    watcher.setPaths(dependents.keys())
+                for index in sorted(affected | rescanned):
+                    printBuildResult(buildManifestProfile(specs[index], plist_cache))
+    finally:
+        watcher.close()
+
+
+def runWatch(specs, options, plist_cache=None):
+    """Run watchProfiles() for specs with the watch options, until interrupted."""
+    try:
+        watchProfiles(specs,
+            debounce=options.watch_debounce,
+            poll_interval=options.watch_interval,
+            use_inotify=not options.watch_poll,
+            plist_cache=plist_cache)
+    except KeyboardInterrupt:
+        pass
+
+
+MANAGE_OFTEN_WARNING = ("WARNING: Deploying profiles configured for 'Often' settings "
+                        "management is known to have undesirable effects on OS X "
+                        "Yosemite. \n"
+                        "         Consider using 'Once' instead, and see this repo's "
+                        "README for links to more documentation.")
+
+
+def runManifest(options):
+    """Build all profiles listed in options.manifest, report per-profile errors
+    and a throughput summary, and return the exit status."""
+    defaults = dict(getProfileSpecSettings(options), manage=options.manage)
+    try:
+        specs = readManifest(options.manifest, defaults)
+    except ProfileBuildError as error:
+        errorAndExit(str(error))
+    for spec in specs:
+        if spec['manage'] == 'Often':
+            print("%s: %s" % (spec['identifier'], MANAGE_OFTEN_WARNING), file=sys.stderr)
+
+    if options.watch:
+        runWatch(specs, options)
+        return 0
+
+    start = time.time()
+    results = buildManifest(specs, jobs=options.jobs)
+    elapsed = time.time() - start
+
+    failed = [r for r in results if r['error']]
+    skipped = [r for r in results if r['skipped']]
+    for result in failed:
+        print("Error building %s: %s" % (result['identifier'], result['error']), file=sys.stderr)
+    print("Built %d of %d profiles (%d unchanged) in %.2f seconds (%.1f profiles/s) using %d jobs" % (
+        len(results) - len(failed) - len(skipped), len(results), len(skipped), elapsed,
+        len(results) / elapsed if elapsed else 0, options.jobs))
+    if failed:
+        return 1
+    return 0
+
+
+def runTemplate(profile, options):
+    """Write a profile for each row of options.template_csv from profile, whose
+    strings contain placeholders for the CSV's columns, and return the exit status.
+    Profiles are written to options.output, or to '<identifier>.mobileconfig', after
+    filling in any placeholders in the path."""
+    try:
+        with open(options.template_csv) as csv_file:
+            reader = csv.DictReader(csv_file, restval='')
+            rows = list(reader)
+            columns = set(reader.fieldnames or [])
+    except (IOError, OSError, csv.Error) as error:
+        errorAndExit("Error reading template CSV %s: %s" % (options.template_csv, error))
+    try:
+        template = ProfileTemplate(profile, options.deterministic)
+    except ProfileBuildError as error:
+        errorAndExit("Error: %s" % error)
+    output_pattern = options.output or os.path.join(os.getcwd(), options.identifier + '.mobileconfig')
+    missing = (set(template.columns) | set(TEMPLATE_PLACEHOLDER.findall(output_pattern))) - columns
+    if missing:
+        errorAndExit("Error: The template CSV %s has no column for %s" % (
+            options.template_csv, ', '.join("'{{%s}}'" % column for column in sorted(missing))))
+    output_paths = [fillTemplate(output_pattern, row) for row in rows]
+    if len(set(output_paths)) < len(output_paths):
+        errorAndExit("Error: Some rows of %s would be written to the same path; "
+                     "use placeholders in '--output' or '--identifier'." % options.template_csv)
+
+    start = time.time()
+    failed = 0
+    for line, (row, output_path) in enumerate(zip(rows, output_paths), 2):
+        try:
+            with timedPhase('serialize', path=output_path, format='xml'):
+                _writeFileAtomically(template.render(row), output_path)
+        except (ValueError, NSPropertyListWriteException) as error:
+            print("Error writing %s for line %d of %s: %s" % (
+                output_path, line, options.template_csv, error), file=sys.stderr)
+            failed += 1
+    elapsed = time.time() - start
+    print("Wrote %d of %d profiles in %.2f seconds (%.1f profiles/s)" % (
+        len(rows) - failed, len(rows), elapsed, len(rows) / elapsed if elapsed else 0))
+    if failed:
+        return 1
+    return 0
+
+
+def writeSplitProfiles(profile, output_path, options):
+    """Split profile into profiles within options.max_size megabytes and
+    options.max_payloads payloads, see PayloadDict.split(), and write them to
+    '<output_path>.<n>.mobileconfig' along with a JSON manifest listing them in
+    '<output_path>.manifest.json'. Returns the exit status."""
+    max_bytes = options.max_size and int(options.max_size * 1024 * 1024)
+    parts = profile.split(max_bytes, options.max_payloads, options.output_format)
+    if output_path.endswith('.mobileconfig'):
+        base_path = output_path[:-len('.mobileconfig')]
+    else:
+        base_path = output_path
+    entries = []
+    for index, (part, estimate) in enumerate(parts, 1):
+        part_path = output_path if len(parts) == 1 else '%s.%d.mobileconfig' % (base_path, index)
+        try:
+            part.finalizeAndSave(part_path,
+                streaming=options.stream_output,
+                output_format=options.output_format)
+        except FoundationPlistException as error:
+            errorAndExit("Error writing profile to %s: %s" % (part_path, error))
+        size = os.path.getsize(part_path)
+        if max_bytes and size > max_bytes:
+            print("WARNING: %s is %d bytes, over the size limit, as its payload alone "
+                  "doesn't fit" % (part_path, size), file=sys.stderr)
+        part_data = part.data
+        entries.append({'identifier': part_data['PayloadIdentifier'],
+                        'uuid': part_data['PayloadUUID'],
+                        'output': os.path.abspath(part_path),
+                        'bytes': size,
+                        'payloads': len(part_data['PayloadContent']),
+                        'domains': [domain for payload in part_data['PayloadContent']
+                                    for domain in sorted(payload['PayloadContent'].keys())]})
+    manifest_path = base_path + '.manifest.json'
+    manifest = {'identifier': profile.data['PayloadIdentifier'], 'profiles': entries}
+    try:
+        _writeFileAtomically((json.dumps(manifest, indent=2, sort_keys=True) + '\n').encode('UTF-8'),
+                             manifest_path)
+    except NSPropertyListWriteException as error:
+        errorAndExit(str(error))
+    print("Wrote %d profiles, listed in %s" % (len(entries), manifest_path))
+    return 0
+
+
+def runInventory(options):
+    """Update the inventory index of options.inventory unless options.no_update
+    is set, print the profiles matching any queries, and return the exit status."""
+    db_path = options.inventory_db or os.path.join(options.inventory, '.mcxinventory.sqlite')
+    querying = options.find_domain or options.find_key or options.find_identifier
+    inventory = ProfileInventory(options.inventory, db_path)
+    try:
+        if not options.no_update:
+            start = time.time()
+            counts = inventory.update(options.jobs)
+            counts['seconds'] = time.time() - start
+            print("Indexed %(added)d new, %(updated)d changed and %(removed)d removed profiles "
+                  "(%(unchanged)d unchanged, %(errors)d unreadable) in %(seconds).2f seconds" % counts,
+                  file=sys.stderr if querying else sys.stdout)
+            for profile_path, error in inventory.errors():
+                print("WARNING: Couldn't read %s: %s" % (profile_path, error), file=sys.stderr)
+        if querying:
+            start = time.time()
+            matches = inventory.find(domain=options.find_domain,
+                                     key=options.find_key,
+                                     identifier=options.find_identifier)
+            for match in matches:
+                print('\t'.join(str(value) for value in match if value is not None))
+            print("%d matches in %.1f ms" % (len(matches), (time.time() - start) * 1000),
+                  file=sys.stderr)
+    finally:
+        inventory.close()
+    return 0
+
+
+# Set in the processes that handle a server's requests
+_serving = False
+
+# Requests that can't be built in a forked process run this script in a new one
+_SCRIPT_PATH = os.path.abspath(__file__)
+
+
+def _handleServerRequest(conn):
+    """Run the build request read from the connection conn as if its arguments had
+    been given on the command line, and send back its exit status and output. The
+    output is collected from file descriptors 1 and 2, so it includes that of worker
+    processes and tools run for the request."""
+    global _serving, _instrumented, _phase_timer
+    _serving = True
+    # Instrument the request as asked for by its own options, not the server's
+    _instrumented = False
+    _phase_timer = None
+    sys.setprofile(None)
+    request_data = b''
+    while not request_data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        request_data += chunk
+    captured = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(captured[0].fileno(), 1)
+    os.dup2(captured[1].fileno(), 2)
+    status = 0
+    try:
+        request = json.loads(request_data.decode('UTF-8'))
+        os.chdir(request.get('cwd') or '/')
+        args = [str(arg) for arg in request.get('args', [])]
+        sys.argv = sys.argv[0:1] + args
+        main(args)
+    except SystemExit as exit_request:
+        status = exit_request.code
+        if status is None:
+            status = 0
+        elif not isinstance(status, _int_types):
+            print(status, file=sys.stderr)
+            status = 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    output = []
+    for captured_file in captured:
+        captured_file.seek(0)
+        output.append(captured_file.read().decode('UTF-8', 'replace'))
+        captured_file.close()
+    response = {'status': status, 'stdout': output[0], 'stderr': output[1]}
+    conn.sendall(json.dumps(response).encode('UTF-8') + b'\n')
+
+
+def serve(socket_path, max_workers=8):
+    """Accept build requests on a Unix socket at socket_path until interrupted or
+    terminated. Each request is a line of JSON with the command-line 'args' list and
+    the 'cwd' to run them in, and is answered with a line of JSON with its exit
+    'status' and its 'stdout' and 'stderr' output.
+
+    Requests run in processes forked from the server, at most max_workers at a time,
+    so they start with the modules, plist backend and git revision already loaded and
+    don't share any other state. CoreFoundation can't be used in a process forked
+    without exec, so the server uses the plistlib backend, and requests that need
+    Foundation are run in a new process."""
+    import socket
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            # Left behind by a server that didn't exit cleanly
+            os.remove(socket_path)
+        else:
+            raise ProfileBuildError("A server is already listening on %s" % socket_path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(128)
+
+    getPlistBackend()
+    getGitRevision()
+
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    print("Listening on %s" % socket_path, file=sys.stderr)
+
+    workers = set()
+    try:
+        while True:
+            while workers:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                workers.discard(pid)
+            if len(workers) >= max_workers:
+                pid, _ = os.waitpid(-1, 0)
+                workers.discard(pid)
+                continue
+            conn, _ = server.accept()
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                server.close()
+                status = 0
+                try:
+                    _handleServerRequest(conn)
+                except Exception:
+                    status = 1
+                finally:
+                    conn.close()
+                    os._exit(status)
+            conn.close()
+            workers.add(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+        for pid in workers:
+            os.waitpid(pid, 0)
+
+
+def main(argv=None):
     parser = optparse.OptionParser()
     parser.set_usage(
-        """usage: %prog [--dsobject DSOBJECT | --plist PLIST | --defaults DOMAIN]
+        """usage: %prog [--dsobject DSOBJECT | --dsnode DSPATH | --plist PLIST | --defaults DOMAIN | --harvest DIR]
                        [--identifier IDENTIFIER | --identifier-from-profile PATH] [options]
-       One of '--dsobject', '--plist', or '--defaults' must be specified, and only one identifier option.
+       One of '--dsobject', '--dsnode', '--plist', '--defaults' or '--harvest' must be specified, and only one identifier option.
        Run '%prog --help' for more information.""")
 
     # Required options
@@ -371,6 +3029,11 @@ Examples: /Local/Default/Computers/foo
     parser.add_option('--plist', '-p', action="append", metavar='PLIST_FILE',
         help="""Path to a plist to be added as a profile payload.
 Can be specified multiple times.""")
+    parser.add_option('--plist-dir', action="append", metavar='DIR',
+        help="""Directory to search recursively for plists to be added as profile payloads,
+such as a copy of /Library/Preferences. Plists are parsed in parallel by '--jobs'
+worker processes and added in sorted path order; unreadable plists are skipped.
+Can be specified multiple times, and combined with --plist.""")
     parser.add_option('--defaults', action="append", metavar='APP_ID',
         help="""Default or preferences application id to be added as profile payload.
 Can be specified multiple times. User NSGlobalDomain to designate the global or 'anyApp' domain.""")
@@ -401,6 +3064,36 @@ and UUID, as opposed to specifying it with the --identifier option.""")
         action="store",
         default="",
         help="Display name for profile. Defaults to 'MCXToProfile: <first domain>'.")
+    parser.add_option('--deterministic',
+        action="store_true",
+        default=False,
+        help="""Derive the profile and payload UUIDs from the identifier and payload
+contents instead of generating random ones, so that unchanged input produces an
+identical profile.""")
+    parser.add_option('--cache-dir',
+        action="store",
+        metavar="PATH",
+        help="""Directory in which to record the inputs of each profile built from
+plists. A profile whose plists and options are unchanged since it was last written
+is skipped. Most useful together with --deterministic.""")
+    parser.add_option('--stream-output',
+        action="store_true",
+        default=False,
+        help="""Write the profile's XML incrementally to the output file instead of
+serializing it in memory first, keeping memory use low for very large payloads.""")
+    parser.add_option('--output-format',
+        action="store",
+        choices=list(PLIST_FORMATS),
+        default='xml',
+        help="""Plist format of the written profile: 'xml' or 'binary'. Binary profiles
+are smaller and faster to parse. Defaults to 'xml'. Input plists may be in either format.""")
+    parser.add_option('--plist-backend',
+        action="store",
+        choices=['auto'] + sorted(PLIST_BACKENDS.keys()),
+        default='auto',
+        help="""Plist library used to read and write plists: 'foundation' (PyObjC),
+'plistlib' (Python standard library) or 'auto'. Defaults to 'auto', which uses
+Foundation when it's available and plistlib otherwise.""")
 
     # Plist-specific
     plist_options = optparse.OptionGroup(parser,
@@ -435,22 +3128,375 @@ per-plist basis.""")
         default=False,
         help="""When using the '--defaults' option this looks in the 'anyUser' domain, i.e. /Library/Preferences, rather than ~/Library/Preferences.""" )
 
-    options, args = parser.parse_args()
+    # Template specific
+    template_options = optparse.OptionGroup(parser,
+        title="Template options",
+        description="""Write variants of one profile, such as one per machine, that differ
+only in a few values. Placeholders like '{{hostname}}' in any string of the input
+plists, and in '--identifier', '--displayname', '--organization' and '--output',
+are replaced with the values of a CSV's columns.""")
+
+    parser.add_option_group(template_options)
+
+    template_options.add_option('--template-csv',
+        action="store",
+        metavar="PATH",
+        help="""CSV file with a header row naming the placeholders' columns. A profile
+is written for each row. The profile is built and serialized once, and only each
+row's values and new UUIDs are encoded for it.""")
+
+    # Harvest specific
+    harvest_options = optparse.OptionGroup(parser,
+        title="Harvest options",
+        description="""Build profiles from the preference plists of Library/Preferences
+directories, such as those of a golden image or of many home directories, without
+CFPreferences. '--manage' applies to the harvested preferences.""")
+
+    parser.add_option_group(harvest_options)
+
+    harvest_options.add_option('--harvest',
+        action="append",
+        metavar="DIR",
+        help="""Add a payload for each preference plist in DIR and its ByHost
+subdirectory. DIR is a Library/Preferences directory, or a home directory or volume
+containing one. Can be specified multiple times. Plists are parsed in parallel by
+'--jobs' worker processes.""")
+    harvest_options.add_option('--harvest-split',
+        action="store_true",
+        default=False,
+        help="""Write a profile for each harvested domain, named '<identifier>.<domain>',
+to the '--output' directory instead of a single profile.""")
+
+    # Directory Services specific
+    ds_options = optparse.OptionGroup(parser,
+        title="Directory Services options",
+        description="""These options are useful only in conjunction with --dsobject
+or --dsnode.""")
+
+    parser.add_option_group(ds_options)
+
+    ds_options.add_option('--dsnode',
+        action="store",
+        metavar="DSPATH",
+        help="""Directory Services path whose records are each converted to a
+profile named '<identifier>.<record name>', written to the '--output' directory.
+Example: /LDAPv3/some_ldap_server/ComputerGroups""")
+    ds_options.add_option('--domain',
+        action="append",
+        metavar="DOMAIN",
+        help="""With '--dsobject', only convert the MCX settings for this preference
+domain. Other domains' settings aren't decoded. Can be specified multiple times.""")
+    ds_options.add_option('--concurrency',
+        action="store",
+        type="int",
+        default=8,
+        help="Maximum number of concurrent dscl processes with '--dsnode'. Defaults to 8.")
+    ds_options.add_option('--dscl-timeout',
+        action="store",
+        type="float",
+        metavar="SECONDS",
+        default=60,
+        help="Seconds after which a dscl command is killed. Defaults to 60.")
+    ds_options.add_option('--dscl-retries',
+        action="store",
+        type="int",
+        default=2,
+        help="Number of times a failed dscl command is retried. Defaults to 2.")
+    ds_options.add_option('--dscl',
+        action="store",
+        metavar="PATH",
+        default=DSCL,
+        help="Path to the dscl executable. Defaults to %s." % DSCL)
+    ds_options.add_option('--ds-cache',
+        action="store",
+        metavar="PATH",
+        help="""Directory in which to cache dscl responses, so that repeated exports
+of the same records don't query the node again.""")
+    ds_options.add_option('--ds-cache-ttl',
+        action="store",
+        type="float",
+        metavar="SECONDS",
+        default=3600,
+        help="Seconds for which a cached dscl response is used. Defaults to 3600.")
+    ds_options.add_option('--ds-cache-size',
+        action="store",
+        type="float",
+        metavar="MB",
+        default=100,
+        help="""Size in megabytes above which the least recently used cached responses
+are removed. Defaults to 100.""")
+    ds_options.add_option('--refresh',
+        action="store_true",
+        default=False,
+        help="Query the node even for cached responses, and update the cache.")
+
+    # Manifest specific
+    manifest_options = optparse.OptionGroup(parser,
+        title="Manifest options",
+        description="""Build many plist-based profiles in one run. Each manifest entry
+may set identifier, plists, manage, output, organization, removal-allowed and
+displayname; the corresponding command-line options are used as defaults.""")
+
+    parser.add_option_group(manifest_options)
+
+    manifest_options.add_option('--manifest',
+        action="store",
+        metavar="PATH",
+        help="""Path to a JSON (array of objects) or CSV (with a header row) list of
+profiles to build. In CSV, separate multiple plists with ';'.""")
+    manifest_options.add_option('--jobs', '-j',
+        action="store",
+        type="int",
+        default=multiprocessing.cpu_count(),
+        help="""Number of worker processes used with '--manifest', '--plist-dir',
+'--harvest' and '--inventory'. Defaults to the number of CPUs.""")
+
+    # Watch specific
+    watch_options = optparse.OptionGroup(parser,
+        title="Watch options",
+        description="""Keep running and rebuild profiles when their source plists
+change. Useful with --plist or --manifest.""")
+
+    parser.add_option_group(watch_options)
+
+    watch_options.add_option('--watch', '-w',
+        action="store_true",
+        default=False,
+        help="""After building, watch the source plists and rebuild the profiles that
+use a plist when it changes. Uses inotify where available, and polling otherwise.""")
+    watch_options.add_option('--watch-debounce',
+        action="store",
+        type="float",
+        metavar="SECONDS",
+        default=0.5,
+        help="Wait until no changes have been seen for this long before rebuilding. Defaults to 0.5.")
+    watch_options.add_option('--watch-interval',
+        action="store",
+        type="float",
+        metavar="SECONDS",
+        default=1.0,
+        help="Interval between checks when polling for changes. Defaults to 1.")
+    watch_options.add_option('--watch-poll',
+        action="store_true",
+        default=False,
+        help="Poll for changes even where inotify is available.")
+
+    parser.add_option('--diff',
+        action="store",
+        metavar="PATH",
+        help="""Compare the new profile with the existing profile at PATH, ignoring UUIDs,
+Once timestamps and the order of payloads, and print the differences. Exits with
+status 1 if anything changed and 0 otherwise. The new profile is only written if
+'--output' is also given.""")
+
+    # Inventory
+    inventory_options = optparse.OptionGroup(parser,
+        title="Inventory options",
+        description="""Index the profiles in a directory in a SQLite database, and
+find the profiles managing a domain or key.""")
+
+    parser.add_option_group(inventory_options)
+
+    inventory_options.add_option('--inventory',
+        action="store",
+        metavar="DIR",
+        help="""Update the index of the '.mobileconfig' files under DIR, reading only
+new and changed files, then answer any '--find' queries.""")
+    inventory_options.add_option('--inventory-db',
+        action="store",
+        metavar="PATH",
+        help="Path of the index database. Defaults to '.mcxinventory.sqlite' in the '--inventory' directory.")
+    inventory_options.add_option('--find-domain',
+        action="store",
+        metavar="DOMAIN",
+        help="List the profiles with settings for a preference domain or payload type.")
+    inventory_options.add_option('--find-key',
+        action="store",
+        metavar="KEY",
+        help="List the profiles and domains that set a preference key.")
+    inventory_options.add_option('--find-identifier',
+        action="store",
+        metavar="IDENTIFIER",
+        help="List the settings in the profiles with a PayloadIdentifier.")
+    inventory_options.add_option('--no-update',
+        action="store_true",
+        default=False,
+        help="Answer queries from the index without checking the directory for changes.")
+
+    # Merging
+    merge_options = optparse.OptionGroup(parser,
+        title="Merging options",
+        description="""Shrink profiles built from several inputs, with --plist,
+--plist-dir, --manifest, --dsobject or --defaults.""")
+
+    parser.add_option_group(merge_options)
+
+    merge_options.add_option('--merge-domains',
+        action="store_true",
+        default=False,
+        help="""Merge the settings of inputs for the same preference domain and
+management state into a single payload, instead of adding a payload for each input.""")
+    merge_options.add_option('--merge-conflicts',
+        action="store",
+        choices=list(MERGE_CONFLICTS),
+        help="""How a key set to different values by merged inputs is resolved: 'last'
+uses the value from the input given last, 'first' the one given first, and 'error'
+stops with an error. Nested dictionaries are merged key by key. Defaults to 'last'.""")
+    merge_options.add_option('--collapse-subtrees',
+        action="store_true",
+        default=False,
+        help="""Store identical dictionaries and arrays in the profile only once, which
+shrinks binary profiles (see --output-format).""")
+    merge_options.add_option('--max-size',
+        action="store",
+        type="float",
+        metavar="MB",
+        help="""Split the payloads into as many profiles as needed to keep each
+under this many megabytes. The profiles are named '<identifier>.<n>' and written to
+'<output>.<n>.mobileconfig', and a JSON manifest listing them is written to
+'<output>.manifest.json'.""")
+    merge_options.add_option('--max-payloads',
+        action="store",
+        type="int",
+        metavar="COUNT",
+        help="Split the payloads into profiles of at most COUNT payloads each, as with '--max-size'.")
+    merge_options.add_option('--size-report',
+        action="store_true",
+        default=False,
+        help="""Print the profile's size with and without merging and collapsing, and
+list its largest duplicated subtrees.""")
+
+    # Server
+    server_options = optparse.OptionGroup(parser,
+        title="Server options",
+        description="""Keep running and build profiles on request, avoiding the cost of
+starting the tool for each profile. Requests are sent by mcxToProfileClient.py, which
+takes the same options as this tool.""")
+
+    parser.add_option_group(server_options)
+
+    server_options.add_option('--serve',
+        action="store",
+        metavar="SOCKET",
+        help="""Listen for requests on a Unix socket created at SOCKET, building up to
+'--jobs' profiles at once. Relative paths in requests are resolved against the
+client's working directory.""")
+
+    # Diagnostics
+    diagnostics_options = optparse.OptionGroup(parser,
+        title="Diagnostics options",
+        description="Report where the time and memory of a run are spent.")
+
+    parser.add_option_group(diagnostics_options)
+
+    diagnostics_options.add_option('--timings',
+        action="store",
+        metavar="PATH",
+        help="""Write a JSON breakdown of the time spent in each phase (dscl,
+CFPreferences, plist decoding, payload assembly, git rev-parse, serialization),
+with per-input sizes and durations, to PATH. Use '-' for standard error.""")
+    diagnostics_options.add_option('--profile',
+        action="store",
+        metavar="PATH",
+        help="Run under a profiler and write its report to PATH.")
+    diagnostics_options.add_option('--profiler',
+        action="store",
+        choices=['cprofile', 'tracemalloc'],
+        default='cprofile',
+        help="""Profiler used with '--profile': 'cprofile' for the functions taking the
+most time, or 'tracemalloc' for the lines allocating the most memory. Defaults to 'cprofile'.""")
+
+    options, args = parser.parse_args(argv)
 
     if len(args):
         parser.print_usage()
         sys.exit(-1)
 
-    number_of_options = int(bool(options.dsobject)) + int(bool(options.plist)) + int(bool(options.defaults))
+    if options.profile and options.profiler == 'tracemalloc':
+        try:
+            import tracemalloc
+        except ImportError:
+            errorAndExit("Error: '--profiler tracemalloc' requires Python 3.4 or later.")
+
+    # Requests sent to a server, whose processes are forked without exec (see serve())
+    if _serving and not (options.serve or options.watch):
+        if options.defaults or options.plist_backend == 'foundation':
+            sys.exit(subprocess.call([sys.executable, _SCRIPT_PATH] + list(argv)))
+        if options.plist_backend == 'auto':
+            options.plist_backend = 'plistlib'
+
+    if (options.timings or options.profile) and not _instrumented:
+        return runInstrumented(lambda: main(argv), options.timings, options.profile, options.profiler)
+
+    if options.serve or (options.watch and _serving):
+        if _serving:
+            errorAndExit("Error: The '--serve' and '--watch' options can't be sent to a server.")
+        if options.dsobject or options.dsnode or options.plist or options.plist_dir or \
+        options.defaults or options.harvest or options.manifest or options.inventory:
+            parser.print_usage()
+            errorAndExit("Error: The '--serve' option can't be combined with input options, which are sent by clients.")
+        if options.plist_backend == 'foundation':
+            errorAndExit("Error: A server always uses the 'plistlib' backend, since Foundation "
+                         "can't be used in the processes forked from it.")
+        setPlistBackend('plistlib')
+        try:
+            serve(options.serve, max_workers=options.jobs)
+        except (ProfileBuildError, EnvironmentError) as err:
+            errorAndExit("Error: %s" % err)
+        return
+
+    if options.stream_output and options.output_format != 'xml':
+        parser.print_usage()
+        errorAndExit("Error: The '--stream-output' option can only write 'xml' profiles.")
+
+    if options.manifest:
+        if options.dsobject or options.plist or options.plist_dir or options.defaults or \
+        options.harvest or options.identifier or options.identifier_from_profile or options.output:
+            parser.print_usage()
+            errorAndExit("Error: The '--manifest' option can't be combined with input, identifier or output options.")
+        if options.size_report or options.diff or options.max_size is not None or \
+        options.max_payloads is not None:
+            parser.print_usage()
+            errorAndExit("Error: The '--size-report', '--diff', '--max-size' and '--max-payloads' "
+                         "options can't be used with '--manifest'.")
+        try:
+            setPlistBackend(options.plist_backend)
+        except ImportError:
+            errorAndExit("Error: the '%s' plist backend is not available." % options.plist_backend)
+        sys.exit(runManifest(options))
+
+    if options.inventory_db or options.find_domain or options.find_key or \
+    options.find_identifier or options.no_update:
+        if not options.inventory:
+            parser.print_usage()
+            errorAndExit("Error: The '--inventory-db', '--find' and '--no-update' options are used only with '--inventory'.")
+
+    if options.inventory:
+        if options.dsobject or options.dsnode or options.plist or options.plist_dir or \
+        options.defaults or options.harvest or options.identifier or \
+        options.identifier_from_profile or options.output:
+            parser.print_usage()
+            errorAndExit("Error: The '--inventory' option can't be combined with input, identifier or output options.")
+        if not os.path.isdir(options.inventory):
+            errorAndExit("No directory exists at %s" % options.inventory)
+        try:
+            setPlistBackend(options.plist_backend)
+        except ImportError:
+            errorAndExit("Error: the '%s' plist backend is not available." % options.plist_backend)
+        sys.exit(runInventory(options))
+
+    number_of_options = int(bool(options.dsobject)) + int(bool(options.dsnode)) + \
+                        int(bool(options.plist or options.plist_dir)) + int(bool(options.defaults)) + \
+                        int(bool(options.harvest))
     if number_of_options > 1:
         parser.print_usage()
-        errorAndExit("Error: The '--dsobject', '--plist', and '--defaults' options are mutually exclusive.")
+        errorAndExit("Error: The '--dsobject', '--dsnode', '--plist', '--defaults' and '--harvest' options are mutually exclusive.")
 
     if number_of_options == 0:
         parser.print_usage()
-        errorAndExit("Error: One of '--dsobject' or '--plist' or '--defaults' must be specified.")
+        errorAndExit("Error: One of '--dsobject' or '--dsnode' or '--plist' or '--defaults' or '--harvest' must be specified.")
 
-    if options.dsobject and options.manage:
+    if (options.dsobject or options.dsnode) and options.manage:
         print(options.manage)
         parser.print_usage()
         errorAndExit("Error: The '--manage' option is used only in conjunction with '--plist'. DS Objects already contain this information.")
@@ -463,11 +3509,89 @@ per-plist basis.""")
         parser.print_usage()
         errorAndExit("Error: The '--anyUser' option is used only with '--defaults'.")
 
+    if options.watch and not (options.plist or options.plist_dir):
+        parser.print_usage()
+        errorAndExit("Error: The '--watch' option is used only with '--plist' or '--manifest'.")
+
+    if options.harvest_split and not options.harvest:
+        parser.print_usage()
+        errorAndExit("Error: The '--harvest-split' option is used only with '--harvest'.")
+
+    if options.harvest_split and (options.diff or options.size_report):
+        parser.print_usage()
+        errorAndExit("Error: The '--diff' and '--size-report' options can't be used with '--harvest-split'.")
+
+    if options.template_csv:
+        if options.dsnode or options.harvest_split or options.watch or options.cache_dir or \
+        options.diff or options.size_report:
+            parser.print_usage()
+            errorAndExit("Error: The '--template-csv' option can't be used with '--dsnode', '--harvest-split', "
+                         "'--watch', '--cache-dir', '--diff' or '--size-report'.")
+        if options.output_format != 'xml' or not options.identifier:
+            parser.print_usage()
+            errorAndExit("Error: The '--template-csv' option writes only 'xml' profiles, and requires '--identifier'.")
+
+    if options.max_size is not None or options.max_payloads is not None:
+        if options.dsnode or options.harvest_split or options.template_csv or options.watch or \
+        options.cache_dir or options.diff:
+            parser.print_usage()
+            errorAndExit("Error: The '--max-size' and '--max-payloads' options can't be used with '--dsnode', "
+                         "'--harvest-split', '--template-csv', '--watch', '--cache-dir' or '--diff'.")
+        if (options.max_size is not None and options.max_size <= 0) or \
+        (options.max_payloads is not None and options.max_payloads < 1):
+            parser.print_usage()
+            errorAndExit("Error: The '--max-size' and '--max-payloads' limits must be positive.")
+
+    if options.merge_conflicts and not options.merge_domains:
+        parser.print_usage()
+        errorAndExit("Error: The '--merge-conflicts' option is used only with '--merge-domains'.")
+
+    if options.dsnode and (options.merge_domains or options.collapse_subtrees or options.size_report):
+        parser.print_usage()
+        errorAndExit("Error: The merging options can't be used with '--dsnode'.")
+
+    if options.diff and (options.dsnode or options.watch or options.cache_dir):
+        parser.print_usage()
+        errorAndExit("Error: The '--diff' option can't be used with '--dsnode', '--watch' or '--cache-dir'.")
+
+    if options.size_report and options.watch:
+        parser.print_usage()
+        errorAndExit("Error: The '--size-report' option can't be used with '--watch'.")
+
+    if options.domain and not options.dsobject:
+        parser.print_usage()
+        errorAndExit("Error: The '--domain' option is used only with '--dsobject'.")
+
+    if options.ds_cache and not (options.dsobject or options.dsnode):
+        parser.print_usage()
+        errorAndExit("Error: The '--ds-cache' option is used only with '--dsobject' or '--dsnode'.")
+
+    if options.refresh and not options.ds_cache:
+        parser.print_usage()
+        errorAndExit("Error: The '--refresh' option is used only with '--ds-cache'.")
+
+    if options.cache_dir and not (options.plist or options.plist_dir):
+        parser.print_usage()
+        errorAndExit("Error: The '--cache-dir' option is used only with '--plist' or '--manifest'.")
+
     if (not options.identifier and not options.identifier_from_profile) or \
     (options.identifier and options.identifier_from_profile):
         parser.print_usage()
         errorAndExit("Error: identifier must be provided with either '--identifier' or '--identifier-from-profile'")
 
+    if options.dsnode and not options.identifier:
+        parser.print_usage()
+        errorAndExit("Error: The '--dsnode' option requires '--identifier', which is used as a prefix for each record's profile.")
+
+    if options.harvest_split and not options.identifier:
+        parser.print_usage()
+        errorAndExit("Error: The '--harvest-split' option requires '--identifier', which is used as a prefix for each domain's profile.")
+
+    try:
+        setPlistBackend(options.plist_backend)
+    except ImportError:
+        errorAndExit("Error: the '%s' plist backend is not available." % options.plist_backend)
+
     if options.identifier:
         identifier = options.identifier
         uuid = False
@@ -476,7 +3600,38 @@ per-plist basis.""")
             errorAndExit("Error reading a profile at path %s" % options.identifier_from_profile)
         identifier, uuid = getIdentifierFromProfile(options.identifier_from_profile)
 
-    if options.plist or options.defaults:
+    plist_paths = list(options.plist or [])
+    plist_cache = {}
+    if options.plist_dir:
+        found_paths = []
+        for plist_dir in options.plist_dir:
+            if not os.path.isdir(plist_dir):
+                errorAndExit("No directory exists at %s" % plist_dir)
+            found = findPlists(plist_dir)
+            if not found:
+                print("WARNING: No plists found in %s" % plist_dir, file=sys.stderr)
+            found_paths.extend(found)
+        # Unreadable plists found in a directory are skipped, but those given
+        # with '--plist' still fail the build when they're read
+        for plist_path, source_data, errmsg in readPlistsInParallel(found_paths, options.jobs):
+            if errmsg:
+                print("WARNING: Skipping %s: %s" % (plist_path, errmsg), file=sys.stderr)
+            else:
+                plist_paths.append(plist_path)
+                plist_cache[plist_path] = source_data
+
+    harvested = []
+    if options.harvest:
+        for harvest_root in options.harvest:
+            if not os.path.isdir(harvest_root):
+                errorAndExit("No directory exists at %s" % harvest_root)
+        harvested, harvest_errors = harvestPreferences(options.harvest, options.jobs)
+        for plist_path, errmsg in harvest_errors:
+            print("WARNING: Skipping %s: %s" % (plist_path, errmsg), file=sys.stderr)
+        if not harvested:
+            errorAndExit("Error: No preferences found in %s" % ', '.join(options.harvest))
+
+    if plist_paths or options.defaults or harvested:
         if not options.manage:
             manage = 'Always'
         else:
@@ -484,55 +3639,164 @@ per-plist basis.""")
     else:
         manage = None
     if manage == 'Often':
-        print(("WARNING: Deploying profiles configured for 'Often' settings "
-             "management is known to have undesirable effects on OS X "
-             "Yosemite. \n"
-             "         Consider using 'Once' instead, and see this repo's "
-             "README for links to more documentation."), file=sys.stderr)
+        print(MANAGE_OFTEN_WARNING, file=sys.stderr)
+
 
+    ds_cache = None
+    if options.ds_cache:
+        ds_cache = DSResponseCache(options.ds_cache,
+            ttl=options.ds_cache_ttl,
+            max_bytes=int(options.ds_cache_size * 1024 * 1024),
+            refresh=options.refresh)
+
+    if options.dsnode:
+        output_dir = options.output or os.getcwd()
+        if not os.path.isdir(output_dir):
+            errorAndExit("Error: With '--dsnode', '--output' must be an existing directory.")
+        try:
+            failures = exportDSNode(options.dsnode, identifier, output_dir,
+                concurrency=options.concurrency,
+                dscl=options.dscl,
+                timeout=options.dscl_timeout,
+                retries=options.dscl_retries,
+                removal_allowed=options.removal_allowed,
+                organization=options.organization,
+                displayname=options.displayname,
+                deterministic=options.deterministic,
+                streaming=options.stream_output,
+                output_format=options.output_format,
+                cache=ds_cache)
+        except DirectoryServicesError as error:
+            errorAndExit(str(error))
+        if failures:
+            sys.exit(1)
+        return
+
+    if options.harvest_split:
+        output_dir = options.output or os.getcwd()
+        if not os.path.isdir(output_dir):
+            errorAndExit("Error: With '--harvest-split', '--output' must be an existing directory.")
+        failures = exportHarvest(harvested, identifier, output_dir, manage,
+            removal_allowed=options.removal_allowed,
+            organization=options.organization,
+            displayname=options.displayname,
+            deterministic=options.deterministic,
+            merge_domains=options.merge_domains,
+            merge_conflicts=options.merge_conflicts or 'last',
+            collapse_subtrees=options.collapse_subtrees,
+            streaming=options.stream_output,
+            output_format=options.output_format)
+        if failures:
+            sys.exit(1)
+        return
 
     if options.output:
         output_file = options.output
     else:
         output_file = os.path.join(os.getcwd(), identifier + '.mobileconfig')
 
-    newPayload = PayloadDict(identifier=identifier,
-        uuid=uuid,
-        removal_allowed=options.removal_allowed,
-        organization=options.organization,
-        displayname=options.displayname)
-
-    if options.plist:
-        for plist_path in options.plist:
-            if not os.path.exists(plist_path):
-                errorAndExit("No plist file exists at %s" % plist_path)
-            try:
-                source_data = readPlist(plist_path)
-            except FoundationPlistException:
-                errorAndExit("Error decoding plist data in file %s" % plist_path)
+    spec = dict(getProfileSpecSettings(options),
+                identifier=identifier, uuid=uuid, plists=plist_paths, manage=manage,
+                output=output_file)
+    if options.watch:
+        spec['plist-dirs'] = options.plist_dir
+        runWatch([spec], options, plist_cache)
+        return
+
+    cache_key = None
+    if options.cache_dir:
+        cache = BuildCache(options.cache_dir)
+        cache_key = getPlistProfileCacheKey(cache, spec)
+        if cache_key and cache.isFresh(cache_key, output_file):
+            print("%s is unchanged, skipping." % output_file)
+            return
 
-            source_domain = getDomainFromPlist(plist_path)
-            newPayload.addPayloadFromPlistContents(source_data,
-                source_domain['name'],
-                manage,
-                is_byhost=source_domain['is_byhost'])
+    mcx_data = []
     if options.dsobject:
-        mcx_data = getMCXData(options.dsobject)
-        # Each domain in the MCX blob gets its own payload
-        for mcx_domain in mcx_data:
-            newPayload.addPayloadFromMCX(mcx_domain)
+        try:
+            mcx_data = list(getMCXData(options.dsobject,
+                dscl=options.dscl,
+                timeout=options.dscl_timeout,
+                retries=options.dscl_retries,
+                cache=ds_cache,
+                domains=options.domain))
+        except DirectoryServicesError as error:
+            errorAndExit(str(error))
+        if options.domain and not mcx_data:
+            errorAndExit("None of the requested domains are in the MCXSettings of %s" %
+                         options.dsobject)
+    defaults_data = []
     if options.defaults:
         for defaults_domain in options.defaults:
-            defaults_data = getDefaultsData(defaults_domain, options.currentHost, options.anyUser)
-            isByHost = options.currentHost and not options.anyUser
-
-            newPayload.addPayloadFromPlistContents(defaults_data,
+            defaults_data.append((defaults_domain,
+                getDefaultsData(defaults_domain, options.currentHost, options.anyUser)))
+    isByHost = options.currentHost and not options.anyUser
+
+    def buildProfile(merge_domains):
+        profile = PayloadDict(identifier=identifier,
+            uuid=uuid,
+            removal_allowed=options.removal_allowed,
+            organization=options.organization,
+            displayname=options.displayname,
+            deterministic=options.deterministic,
+            merge_domains=merge_domains,
+            merge_conflicts=options.merge_conflicts or 'last')
+        if plist_paths:
+            addPlistPayloads(profile, plist_paths, manage, plist_cache)
+        # Each domain in the MCX blob gets its own payload
+        for mcx_domain in mcx_data:
+            profile.addPayloadFromMCX(mcx_domain)
+        for defaults_domain, domain_data in defaults_data:
+            profile.addPayloadFromPlistContents(domain_data,
                 defaults_domain,
                 manage,
                 isByHost)
+        for _, harvest_domain, is_byhost, preferences in harvested:
+            profile.addPayloadFromPlistContents(preferences, harvest_domain, manage, is_byhost)
+        return profile
+
+    try:
+        newPayload = buildProfile(options.merge_domains)
+        if options.size_report:
+            unmerged = buildProfile(False)
+    except ProfileBuildError as error:
+        errorAndExit(str(error))
+    if options.collapse_subtrees:
+        newPayload.collapseDuplicateSubtrees()
+    if options.template_csv:
+        sys.exit(runTemplate(newPayload, options))
+    if options.size_report:
+        try:
+            printSizeReport(unmerged, newPayload, options.output_format)
+        except FoundationPlistException as error:
+            errorAndExit("Error serializing profile: %s" % error)
 
-    newPayload.finalizeAndSave(output_file)
+    if options.max_size is not None or options.max_payloads is not None:
+        sys.exit(writeSplitProfiles(newPayload, output_file, options))
 
+    changes = None
+    if options.diff:
+        if not os.path.exists(options.diff):
+            errorAndExit("Error reading a profile at path %s" % options.diff)
+        try:
+            existing = readProfile(options.diff)
+        except (FoundationPlistException, EnvironmentError) as error:
+            errorAndExit("Error reading the profile at %s: %s" % (options.diff, error))
+        changes = diffProfiles(existing, newPayload.data)
+        printProfileDiff(changes, options.diff)
+        if not options.output:
+            sys.exit(1 if changes else 0)
+
+    try:
+        newPayload.finalizeAndSave(output_file,
+            streaming=options.stream_output,
+            output_format=options.output_format)
+    except FoundationPlistException as error:
+        errorAndExit("Error writing profile to %s: %s" % (output_file, error))
+    if cache_key:
+        cache.record(cache_key, output_file)
+    if changes:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
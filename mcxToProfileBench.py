@@ -0,0 +1,588 @@
+#!/usr/bin/python
+
+# mcxToProfileBench.py
+# Benchmarks for mcxToProfile.py
+
+from __future__ import print_function
+
+import sys
+import os
+import optparse
+import subprocess
+import shutil
+import tempfile
+import time
+import json
+import platform
+import contextlib
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import mcxToProfile
+
+
+def availableBackends():
+    """Return the names of the plist backends that can be loaded here."""
+    names = []
+    for name in sorted(mcxToProfile.PLIST_BACKENDS.keys()):
+        try:
+            mcxToProfile.setPlistBackend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+# Results of every benchmark run in this process, saved with --json
+RESULTS = []
+
+
+def record(benchmark, case, **metrics):
+    """Add one measurement to RESULTS."""
+    result = {'benchmark': benchmark, 'case': case}
+    result.update(metrics)
+    RESULTS.append(result)
+    return result
+
+
+def tracedPeak(func):
+    """Call func once while tracing allocations, and return the peak memory
+    allocated during the call in MB, or None without tracemalloc (Python 2).
+    Traced separately from the timed calls, since tracing slows allocation down."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def formatPeak(peak):
+    if peak is None:
+        return '      - MB'
+    return '%7.1f MB' % peak
+
+
+def percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def recordSamples(benchmark, case, samples, items=1, peak_func=None, **metrics):
+    """Record latency percentiles and throughput for a list of per-call durations
+    in seconds, where each call processed items items, and print a summary. If
+    peak_func is given, the peak memory traced while calling it once is recorded
+    as the case's peak_traced_mb."""
+    samples = sorted(samples)
+    total = sum(samples)
+    result = record(benchmark, case,
+        calls=len(samples),
+        mean_ms=total / len(samples) * 1000,
+        p50_ms=percentile(samples, 0.5) * 1000,
+        p90_ms=percentile(samples, 0.9) * 1000,
+        p99_ms=percentile(samples, 0.99) * 1000,
+        items_per_s=items * len(samples) / total if total else None,
+        peak_traced_mb=peak_func and tracedPeak(peak_func),
+        **metrics)
+    print("%-10s %-40s p50 %9.3f ms  p90 %9.3f ms  p99 %9.3f ms  %10.1f/s  peak %s" % (
+        benchmark, case, result['p50_ms'], result['p90_ms'], result['p99_ms'],
+        result['items_per_s'] or 0, formatPeak(result['peak_traced_mb'])))
+    return result
+
+
+def makePreferences(keys, depth=1, blob_size=0):
+    """Return a synthetic preferences dict with the given number of keys at
+    each level and nested dicts down to depth, plus a data blob of blob_size bytes
+    if given."""
+    prefs = {}
+    if blob_size:
+        prefs['Blob'] = os.urandom(blob_size)
+    for i in range(keys):
+        if depth > 1 and i % 10 == 0:
+            prefs['Nested%d' % i] = makePreferences(keys, depth - 1)
+        elif i % 3 == 0:
+            prefs['Integer%d' % i] = i
+        elif i % 3 == 1:
+            prefs['Bool%d' % i] = bool(i % 2)
+        else:
+            prefs['String%d' % i] = 'value %d' % i
+    return prefs
+
+
+def sampleCall(func, iterations):
+    """Return a list of the wall-clock times in seconds of iterations calls of func."""
+    samples = []
+    for _ in range(iterations):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def timeCall(func, iterations):
+    """Return the median wall-clock time in seconds for one call of func."""
+    samples = sorted(sampleCall(func, iterations))
+    return samples[len(samples) // 2]
+
+
+def benchBackends(options):
+    """Compare startup time and read/write throughput of the plist backends."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        plist_path = os.path.join(tmp_dir, 'com.example.bench.plist')
+        out_path = os.path.join(tmp_dir, 'bench.mobileconfig')
+        mcxToProfile.setPlistBackend('plistlib')
+        mcxToProfile.writePlist(makePreferences(options.keys, options.depth), plist_path)
+        plist_size = os.path.getsize(plist_path)
+        script_dir = os.path.dirname(os.path.abspath(mcxToProfile.__file__))
+
+        results = {}
+        for name in availableBackends():
+            startup_cmd = [sys.executable, '-c',
+                'import mcxToProfile; mcxToProfile.setPlistBackend(%r)' % name]
+            startup = timeCall(lambda: subprocess.check_call(startup_cmd, cwd=script_dir),
+                               options.iterations)
+
+            mcxToProfile.setPlistBackend(name)
+            results[name] = mcxToProfile.readPlist(plist_path)
+            read = timeCall(lambda: mcxToProfile.readPlist(plist_path), options.iterations)
+
+            def build():
+                profile = mcxToProfile.PayloadDict('com.example.bench')
+                profile.addPayloadFromPlistContents(
+                    mcxToProfile.readPlist(plist_path), 'com.example.bench', 'Always')
+                profile.finalizeAndSave(out_path)
+            write = timeCall(build, options.iterations)
+
+            record('backends', name, startup_ms=startup * 1000,
+                   read_mb_per_s=plist_size / read / 1e6, build_per_s=1 / write)
+            print("%-10s startup %8.1f ms  read %8.2f MB/s  build %8.1f profiles/s" % (
+                name, startup * 1000, plist_size / read / 1e6, 1 / write))
+
+        decoded = list(results.values())
+        if [r for r in decoded[1:] if r != decoded[0]]:
+            print("WARNING: backends decoded %s differently" % plist_path, file=sys.stderr)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+FAKE_DSCL = """#!%(python)s
+# Stand-in for dscl serving %(records)d ComputerGroups with MCXSettings
+import sys, time
+time.sleep(%(delay)f)
+args = [a for a in sys.argv[1:] if a != '-plist']
+if args[1] == 'list':
+    for i in range(%(records)d):
+        print('group%%d' %% i)
+else:
+    item = ('<?xml version="1.0" encoding="UTF-8"?><plist version="1.0"><dict>'
+            '<key>mcx_application_data</key><dict><key>com.example.%%s</key><dict>'
+            '<key>Forced</key><array><dict><key>mcx_preference_settings</key><dict>'
+            '<key>Enabled</key><true/></dict></dict></array></dict></dict></dict></plist>')
+    item = item %% args[2].split('/')[-1]
+    item = item.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    print('<?xml version="1.0" encoding="UTF-8"?><plist version="1.0"><dict>'
+          '<key>dsAttrTypeStandard:MCXSettings</key><array><string>%%s</string></array>'
+          '</dict></plist>' %% item)
+"""
+
+
+def writeFakeDscl(directory, records, delay):
+    """Write an executable dscl stand-in to directory, serving records
+    ComputerGroups and sleeping delay seconds per call, and return its path."""
+    path = os.path.join(directory, 'dscl')
+    with open(path, 'w') as dscl_file:
+        dscl_file.write(FAKE_DSCL % {'python': sys.executable, 'records': records, 'delay': delay})
+    os.chmod(path, 0o755)
+    return path
+
+
+@contextlib.contextmanager
+def discardedStdout():
+    """Discard what's printed to standard output in the block, such as the line
+    exportDSNode() prints for each profile, so it doesn't bury the results."""
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+
+def benchDSNode(options):
+    """Compare node-wide MCX export time at increasing dscl concurrency, and with
+    a response cache, using a dscl stand-in with a fixed per-call latency."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dscl = writeFakeDscl(tmp_dir, options.records, options.dscl_delay)
+        mcxToProfile.setPlistBackend('auto')
+        for concurrency in (1, 4, 16):
+            start = time.time()
+            with discardedStdout():
+                failures = mcxToProfile.exportDSNode('/LDAPv3/bench/ComputerGroups',
+                    'com.example.bench', tmp_dir, concurrency=concurrency, dscl=dscl)
+            elapsed = time.time() - start
+            record('dsnode', 'concurrency %d' % concurrency, seconds=elapsed,
+                   records_per_s=options.records / elapsed, failures=len(failures))
+            print("concurrency %3d  %6.2f s  %8.1f records/s  %d failures" % (
+                concurrency, elapsed, options.records / elapsed, len(failures)))
+        # Export again through a response cache, first empty and then filled
+        cache = mcxToProfile.DSResponseCache(os.path.join(tmp_dir, 'cache'))
+        for case in ('cache cold', 'cache warm'):
+            start = time.time()
+            with discardedStdout():
+                failures = mcxToProfile.exportDSNode('/LDAPv3/bench/ComputerGroups',
+                    'com.example.bench', tmp_dir, concurrency=16, dscl=dscl, cache=cache)
+            elapsed = time.time() - start
+            record('dsnode', case, seconds=elapsed,
+                   records_per_s=options.records / elapsed, failures=len(failures))
+            print("%-15s  %6.2f s  %8.1f records/s  %d failures" % (
+                case, elapsed, options.records / elapsed, len(failures)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def makeMCXSettingsResponse(domains, keys):
+    """Return 'dscl -plist read' output for a record with an MCXSettings item
+    for each of domains preference domains, with keys keys each."""
+    items = []
+    for i in range(domains):
+        item = {'mcx_application_data': {'com.example.bench%d' % i: {
+            'Forced': [{'mcx_preference_settings': makePreferences(keys)}]}}}
+        items.append(mcxToProfile.writePlistToString(item).decode('UTF-8'))
+    return mcxToProfile.writePlistToString({'dsAttrTypeStandard:MCXSettings': items})
+
+
+def benchMCXSettings(options):
+    """Compare decoding all the MCXSettings items of a record with selecting one
+    domain, for records with increasing numbers of domains."""
+    mcxToProfile.setPlistBackend(options.plist_backend)
+    for domains in (10, 50, 200):
+        response = makeMCXSettingsResponse(domains, options.keys)
+        for case, selected in (('all', None), ('one domain', ['com.example.bench0'])):
+            decode = lambda: list(mcxToProfile.parseMCXSettings(response, selected))
+            elapsed = timeCall(decode, options.iterations)
+            peak = tracedPeak(decode)
+            result = record('mcxsettings', 'domains=%d %s' % (domains, case),
+                            seconds=elapsed, bytes=len(response), peak_traced_mb=peak)
+            print("%-10s %-40s %9.3f ms  peak %s" % (
+                'mcxsettings', result['case'], elapsed * 1000, formatPeak(peak)))
+
+
+def benchWriter(options):
+    """Compare time and peak traced memory of writePlist() and the streaming
+    writer for profiles embedding increasingly large data blobs."""
+    if tracemalloc is None:
+        print("The 'writer' benchmark requires tracemalloc (Python 3.4 or later).")
+        return
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        out_path = os.path.join(tmp_dir, 'bench.mobileconfig')
+        mcxToProfile.setPlistBackend('auto')
+        for blob_mb in (1, 8, 32):
+            prefs = makePreferences(options.keys, options.depth)
+            prefs['Blob'] = os.urandom(blob_mb * 1024 * 1024)
+            profile = mcxToProfile.PayloadDict('com.example.bench')
+            profile.addPayloadFromPlistContents(prefs, 'com.example.bench', 'Always')
+            for name, write in (('writePlist', mcxToProfile.writePlist),
+                                ('streaming', mcxToProfile.writePlistStreaming)):
+                elapsed = timeCall(lambda: write(profile.data, out_path), 1)
+                peak = tracedPeak(lambda: write(profile.data, out_path))
+                record('writer', '%d MB blob %s' % (blob_mb, name), seconds=elapsed,
+                       peak_traced_mb=peak)
+                print("%3d MB blob  %-10s  %7.2f s  peak %s" % (
+                    blob_mb, name, elapsed, formatPeak(peak)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchFormats(options):
+    """Compare parse time, write time and file size of XML and binary profiles
+    with increasing numbers of payloads."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'bench.mobileconfig')
+        for name in availableBackends():
+            mcxToProfile.setPlistBackend(name)
+            for payloads in (1, 10, 100):
+                profile = mcxToProfile.PayloadDict('com.example.bench')
+                for i in range(payloads):
+                    profile.addPayloadFromPlistContents(
+                        makePreferences(options.keys, options.depth), 'com.example.bench%d' % i, 'Always')
+                for plist_format in mcxToProfile.PLIST_FORMATS:
+                    try:
+                        write = timeCall(lambda: mcxToProfile.writePlist(profile.data, path, plist_format),
+                                         options.iterations)
+                    except mcxToProfile.FoundationPlistException as error:
+                        print("%-10s %-6s %s" % (name, plist_format, error))
+                        continue
+                    read = timeCall(lambda: mcxToProfile.readPlist(path), options.iterations)
+                    record('formats', '%s %d payloads %s' % (name, payloads, plist_format),
+                           write_ms=write * 1000, read_ms=read * 1000, bytes=os.path.getsize(path))
+                    print("%-10s %4d payloads  %-6s  write %8.2f ms  read %8.2f ms  %9d bytes" % (
+                        name, payloads, plist_format, write * 1000, read * 1000, os.path.getsize(path)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchPipeline(options):
+    """Measure each stage of the plist-to-profile pipeline (readPlist,
+    getDomainFromPlist, addPayloadFromPlistContents, _addPayload and
+    finalizeAndSave) for synthetic plists of varying key count, nesting depth and
+    data blob size, and for profiles with increasing numbers of payloads."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mcxToProfile.setPlistBackend(options.plist_backend)
+        out_path = os.path.join(tmp_dir, 'bench.mobileconfig')
+
+        # Plist shapes, varying one dimension at a time from the base shape
+        shapes = [(options.keys, 1, 0)]
+        shapes += [(keys, 1, 0) for keys in (10, 1000) if keys != options.keys]
+        shapes += [(options.keys, depth, 0) for depth in (2, 3)]
+        shapes += [(options.keys, 1, blob_kb * 1024) for blob_kb in (64, 4096)]
+        for keys, depth, blob_size in shapes:
+            case = 'keys=%d depth=%d blob=%dKB' % (keys, depth, blob_size // 1024)
+            plist_path = os.path.join(tmp_dir, 'com.example.bench.001122aabbcc.plist')
+            mcxToProfile.writePlist(makePreferences(keys, depth, blob_size), plist_path)
+            size = os.path.getsize(plist_path)
+
+            read = lambda: mcxToProfile.readPlist(plist_path)
+            recordSamples('readPlist', case, sampleCall(read, options.iterations),
+                peak_func=read, bytes=size)
+            get_domain = lambda: mcxToProfile.getDomainFromPlist(plist_path)
+            recordSamples('getDomain', case, sampleCall(get_domain, options.iterations),
+                peak_func=get_domain)
+            prefs = mcxToProfile.readPlist(plist_path)
+            profile = mcxToProfile.PayloadDict('com.example.bench')
+            add = lambda: profile.addPayloadFromPlistContents(prefs, 'com.example.bench', 'Once', True)
+            recordSamples('addPlist', case, sampleCall(add, options.iterations), peak_func=add)
+            single = mcxToProfile.PayloadDict('com.example.bench')
+            single.addPayloadFromPlistContents(prefs, 'com.example.bench', 'Always')
+            finalize = lambda: single.finalizeAndSave(out_path)
+            recordSamples('finalize', case, sampleCall(finalize, options.iterations),
+                peak_func=finalize, bytes=os.path.getsize(out_path))
+
+        # Multi-domain profiles
+        payload_counts = [n for n in (1, 10, 100, 1000, 10000) if n <= options.max_payloads]
+        prefs = makePreferences(10)
+        for payloads in payload_counts:
+            case = 'payloads=%d' % payloads
+            contents = [{'com.example.bench%d' % i: {'Forced': [{'mcx_preference_settings': prefs}]}}
+                        for i in range(payloads)]
+            profile = mcxToProfile.PayloadDict('com.example.bench')
+            samples = []
+            for content in contents:
+                start = time.time()
+                profile._addPayload(content)
+                samples.append(time.time() - start)
+
+            def addAll():
+                fresh = mcxToProfile.PayloadDict('com.example.bench')
+                for content in contents:
+                    fresh._addPayload(content)
+            recordSamples('_addPayload', case, samples, peak_func=addAll)
+            finalize = lambda: profile.finalizeAndSave(out_path)
+            recordSamples('finalize', case,
+                sampleCall(finalize, max(1, options.iterations // payloads)),
+                items=payloads, peak_func=finalize, bytes=os.path.getsize(out_path))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchPayloads(options):
+    """Measure how PayloadDict scales with the number of payloads: adding,
+    finding by domain, replacing and removing every payload, and building the
+    profile's data. Per-payload times should stay flat as the count grows."""
+    prefs = makePreferences(10)
+    counts = [n for n in (1000, 2000, 5000, 10000, 20000) if n <= options.max_payloads] or \
+             [options.max_payloads]
+    per_payload = {}
+    for payloads in counts:
+        case = 'payloads=%d' % payloads
+        contents = [{'com.example.bench%d' % i: {'Forced': [{'mcx_preference_settings': prefs}]}}
+                    for i in range(payloads)]
+
+        def makeSteps():
+            profile = mcxToProfile.PayloadDict('com.example.bench', deterministic=True)
+            uuids = []
+            return [
+                ('add', lambda: uuids.extend(profile._addPayload(c) for c in contents)),
+                ('find', lambda: [profile.findPayloads('com.example.bench%d' % i) for i in range(payloads)]),
+                ('replace', lambda: [profile.replacePayload(u, c) for u, c in zip(uuids, contents)]),
+                ('data', lambda: profile.data),
+                ('remove', lambda: [profile.removePayload(u) for u in uuids]),
+            ]
+        steps = makeSteps()
+        timings = []
+        for step, func in steps:
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+        # The steps depend on each other, so memory is traced in a second run
+        peaks = [tracedPeak(func) for _, func in makeSteps()]
+        for (step, func), elapsed, peak in zip(steps, timings, peaks):
+            per_payload[(step, payloads)] = elapsed / payloads * 1e6
+            result = record('payloads', '%s %s' % (step, case),
+                seconds=elapsed,
+                us_per_payload=per_payload[(step, payloads)],
+                items_per_s=payloads / elapsed if elapsed else None,
+                peak_traced_mb=peak)
+            print("%-10s %-40s %9.3f s  %8.2f us/payload  peak %s" % (
+                'payloads', result['case'], elapsed, result['us_per_payload'], formatPeak(peak)))
+    if len(counts) > 1:
+        for step, func in steps:
+            print("%-10s %-40s %.2fx the time per payload at %dx the payloads" % (
+                'payloads', 'scaling %s' % step,
+                per_payload[(step, counts[-1])] / (per_payload[(step, counts[0])] or 1e-9),
+                counts[-1] // counts[0]))
+
+
+def benchServer(options):
+    """Compare the latency of building a profile by running mcxToProfile.py with that
+    of sending the same request to a '--serve' server with mcxToProfileClient.py, one
+    request at a time and with 8 at once."""
+    tmp_dir = tempfile.mkdtemp()
+    server = None
+    try:
+        plist_path = os.path.join(tmp_dir, 'com.example.bench.plist')
+        socket_path = os.path.join(tmp_dir, 'bench.sock')
+        mcxToProfile.setPlistBackend('plistlib')
+        mcxToProfile.writePlist(makePreferences(options.keys, options.depth), plist_path)
+        script_dir = os.path.dirname(os.path.abspath(mcxToProfile.__file__))
+        args = ['--plist', plist_path, '--identifier', 'com.example.bench',
+                '--plist-backend', options.plist_backend,
+                '--output', os.path.join(tmp_dir, 'bench.mobileconfig')]
+        env = dict(os.environ, MCXTOPROFILE_SOCKET=socket_path)
+
+        server = subprocess.Popen([sys.executable, os.path.join(script_dir, 'mcxToProfile.py'),
+            '--serve', socket_path], stderr=subprocess.PIPE)
+        server.stderr.readline()
+
+        for case, script in (('cli', 'mcxToProfile.py'), ('client', 'mcxToProfileClient.py')):
+            cmd = [sys.executable, os.path.join(script_dir, script)] + args
+            samples = sampleCall(lambda: subprocess.check_call(cmd, env=env), options.iterations)
+            recordSamples('server', case, samples)
+
+            def concurrent():
+                builds = [subprocess.Popen(cmd, env=env) for _ in range(8)]
+                for build in builds:
+                    build.wait()
+            samples = sampleCall(concurrent, options.iterations)
+            recordSamples('server', '%s x8' % case, samples, items=8)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp_dir)
+
+
+BENCHMARKS = {
+    'backends': benchBackends,
+    'dsnode': benchDSNode,
+    'formats': benchFormats,
+    'mcxsettings': benchMCXSettings,
+    'payloads': benchPayloads,
+    'pipeline': benchPipeline,
+    'server': benchServer,
+    'writer': benchWriter,
+}
+
+
+def compareResults(previous_path):
+    """Print the change in each numeric metric between a previous run saved as
+    JSON and this run's RESULTS, for the cases present in both."""
+    with open(previous_path) as previous_file:
+        previous = dict(((r['benchmark'], r['case']), r)
+                        for r in json.load(previous_file)['results'])
+    print("\nCompared with %s:" % previous_path)
+    for result in RESULTS:
+        old = previous.get((result['benchmark'], result['case']))
+        if not old:
+            continue
+        for metric in ('p50_ms', 'items_per_s', 'seconds', 'write_ms', 'read_ms', 'startup_ms'):
+            if result.get(metric) and old.get(metric):
+                print("%-10s %-40s %-12s %10.3f -> %10.3f  (%+.1f%%)" % (
+                    result['benchmark'], result['case'], metric, old[metric], result[metric],
+                    (result[metric] / old[metric] - 1) * 100))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.set_usage(
+        """usage: %prog [options] BENCHMARK [BENCHMARK ...] | all
+       Available benchmarks: """ + ', '.join(sorted(BENCHMARKS.keys())))
+    parser.add_option('--iterations', '-n',
+        action="store",
+        type="int",
+        default=20,
+        help="Number of timed runs per measurement. Defaults to 20.")
+    parser.add_option('--keys',
+        action="store",
+        type="int",
+        default=100,
+        help="Number of keys per dict in synthetic preference plists. Defaults to 100.")
+    parser.add_option('--depth',
+        action="store",
+        type="int",
+        default=2,
+        help="Nesting depth of synthetic preference plists. Defaults to 2.")
+
+    parser.add_option('--records',
+        action="store",
+        type="int",
+        default=50,
+        help="Number of records served by the dscl stand-in. Defaults to 50.")
+    parser.add_option('--dscl-delay',
+        action="store",
+        type="float",
+        default=0.05,
+        help="Seconds each dscl stand-in call takes. Defaults to 0.05.")
+    parser.add_option('--max-payloads',
+        action="store",
+        type="int",
+        default=10000,
+        help="""Largest number of payloads in a profile for the 'pipeline' and 'payloads'
+benchmarks. Defaults to 10000.""")
+    parser.add_option('--plist-backend',
+        action="store",
+        choices=['auto'] + sorted(mcxToProfile.PLIST_BACKENDS.keys()),
+        default='auto',
+        help="Plist backend used by the 'pipeline', 'mcxsettings' and 'server' benchmarks. Defaults to 'auto'.")
+    parser.add_option('--json',
+        action="store",
+        metavar="PATH",
+        help="Save the results, with details of the environment, as JSON to PATH.")
+    parser.add_option('--compare',
+        action="store",
+        metavar="PATH",
+        help="Compare the results with a previous run saved with '--json'.")
+
+    options, args = parser.parse_args()
+    if args == ['all']:
+        args = sorted(BENCHMARKS.keys())
+    if not args or [a for a in args if a not in BENCHMARKS]:
+        parser.print_usage()
+        sys.exit(-1)
+
+    for name in args:
+        BENCHMARKS[name](options)
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'plist_backend': mcxToProfile.getPlistBackend().name,
+                       'git_revision': mcxToProfile.getGitRevision(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'results': RESULTS}, json_file, indent=2, sort_keys=True)
+    if options.compare:
+        compareResults(options.compare)
+
+
+if __name__ == "__main__":
+    main()
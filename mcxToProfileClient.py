@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# mcxToProfileClient.py
+# Sends its command-line options to a server started with 'mcxToProfile.py --serve'
+# and prints the result, so it can be used in place of mcxToProfile.py. If no server
+# is listening, mcxToProfile.py is run directly instead.
+
+from __future__ import print_function
+
+import sys
+import os
+import json
+import socket
+
+# Environment variable holding the server's socket path
+SOCKET_ENV = 'MCXTOPROFILE_SOCKET'
+DEFAULT_SOCKET = '/tmp/mcxToProfile.%d.sock' % os.getuid()
+
+
+def sendRequest(socket_path, args, cwd):
+    """Send args to the server listening at socket_path, to be run in the directory
+    cwd, and return its response dict with 'status', 'stdout' and 'stderr'."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        request = json.dumps({'args': args, 'cwd': cwd})
+        conn.sendall(request.encode('UTF-8') + b'\n')
+        response_data = b''
+        while not response_data.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            response_data += chunk
+    finally:
+        conn.close()
+    if not response_data:
+        raise socket.error("The server at %s closed the connection without responding" % socket_path)
+    return json.loads(response_data.decode('UTF-8'))
+
+
+def writeOutput(stream, text):
+    if sys.version_info[0] < 3:
+        text = text.encode('UTF-8')
+    stream.write(text)
+    stream.flush()
+
+
+def main():
+    socket_path = os.environ.get(SOCKET_ENV) or DEFAULT_SOCKET
+    args = sys.argv[1:]
+    try:
+        response = sendRequest(socket_path, args, os.getcwd())
+    except socket.error:
+        tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mcxToProfile.py')
+        os.execv(sys.executable, [sys.executable, tool] + args)
+    writeOutput(sys.stdout, response['stdout'])
+    writeOutput(sys.stderr, response['stderr'])
+    sys.exit(response['status'])
+
+
+if __name__ == '__main__':
+    main()